@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import lzma
+import random
+import time
+from pathlib import Path
+
+import sys
+import os
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.json import available_json_backends, json_dumps, json_loads, set_json_backend
+
+
+def process_options():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON backends of toolbox.json")
+
+    parser.add_argument("--file",
+                        dest = "files",
+                        help = "JSON file (optionally .xz) to benchmark, may be given several times (default: generated documents)",
+                        action = "append",
+                        default = [])
+
+    parser.add_argument("--backend",
+                        dest = "backends",
+                        help = "Backend to benchmark, may be given several times (default: all installed ones)",
+                        action = "append",
+                        choices = available_json_backends())
+
+    parser.add_argument("--scale",
+                        dest = "scale",
+                        help = "Size of the generated documents (number of metrics/messages/samples)",
+                        default = 20000,
+                        type = int)
+
+    parser.add_argument("--repeat",
+                        dest = "repeat",
+                        help = "Number of runs per measurement, the best one is reported",
+                        default = 3,
+                        type = int)
+
+    parser.add_argument("--save",
+                        dest = "save",
+                        help = "Write the results to this JSON file",
+                        default = None,
+                        type = str)
+
+    return parser.parse_args()
+
+
+def make_documents(scale):
+    """Return (name, document) pairs shaped like the files toolbox writes and reads."""
+    rnd = random.Random(1)
+    metric_types = [{"idx": i,
+                     "desc": {"class": "throughput", "source": "mpstat", "type": "Busy-CPU"},
+                     "names": {"cpu": str(i % 256), "core": str(i % 64), "package": str(i % 2),
+                               "num": str(i), "type": rnd.choice(["usr", "sys", "irq", "soft"])}}
+                    for i in range(scale)]
+    messages = {"sent": [],
+                "received": [{"timestamp": 1700000000000 + i,
+                              "payload": {"uuid": "%032x" % rnd.getrandbits(128),
+                                          "sender": {"timestamp": 1700000000000 + i, "id": "client-%d" % (i % 32)},
+                                          "recipient": {"type": "all" if i % 3 else "follower",
+                                                        "id": "server-%d" % (i % 32)},
+                                          "message": {"command": "user-object",
+                                                      "user-object": {"svc": {"ip": "10.0.%d.%d" % (i % 255, i % 7),
+                                                                              "ports": [30000 + i % 1000]}}}}}
+                             for i in range(scale)]}
+    result = {"run-id": "%032x" % rnd.getrandbits(128),
+              "iterations": [{"iteration-uid": "%032x" % rnd.getrandbits(128),
+                              "params": [{"arg": "bs", "val": str(2 ** (i % 8))}, {"arg": "rw", "val": "randread"}],
+                              "samples": [{"status": "pass",
+                                           "primary-metric": rnd.random() * 1000000,
+                                           "periods": [{"begin": 1700000000000 + s * 1000,
+                                                        "end": 1700000001000 + s * 1000,
+                                                        "values": [rnd.random() for _ in range(8)]}
+                                                       for s in range(10)]}
+                                          for _ in range(5)]}
+                             for i in range(max(scale // 50, 1))]}
+    return [("metric-types", metric_types), ("roadblock-msgs", messages), ("result", result)]
+
+
+def load_file(filename):
+    opener = lzma.open if filename.endswith(".xz") else open
+    with opener(filename, "rb") as fh:
+        return fh.read()
+
+
+def best_time(repeat, fn, *fn_args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*fn_args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_document(name, text, backends):
+    """Time loading text and dumping the result (pretty and compact) with every backend."""
+    set_json_backend("json")
+    document = json_loads(text)
+    results = []
+    for backend in backends:
+        set_json_backend(backend)
+        result = {"document": name, "backend": backend, "bytes": len(text)}
+        result["load"] = best_time(args.repeat, json_loads, text)
+        result["dump"] = best_time(args.repeat, json_dumps, document, 2, True)
+        result["dump_compact"] = best_time(args.repeat, json_dumps, document)
+        results.append(result)
+    return results
+
+
+def main():
+    backends = args.backends or available_json_backends()
+    if args.files:
+        documents = [(os.path.basename(filename), load_file(filename)) for filename in args.files]
+    else:
+        documents = [(name, json.dumps(document, indent=2, sort_keys=True).encode())
+                     for name, document in make_documents(args.scale)]
+
+    print("%-20s %-9s %10s %10s %10s %12s" % ("document", "backend", "load", "dump", "compact", "load MB/s"))
+    results = []
+    for name, text in documents:
+        for result in bench_document(name, text, backends):
+            print("%-20s %-9s %9.3fs %9.3fs %9.3fs %12.1f" % (
+                name, result["backend"], result["load"], result["dump"], result["dump_compact"],
+                result["bytes"] / result["load"] / 1e6))
+            results.append(result)
+
+    if args.save is not None:
+        with open(args.save, "w") as fh:
+            json.dump({"args": {"scale": args.scale, "repeat": args.repeat, "files": args.files},
+                       "results": results}, fh, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    args = process_options()
+    exit(main())
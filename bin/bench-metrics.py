@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+import argparse
+import gc
+import json
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import sys
+import os
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.cdm_metrics import CDMMetrics
+import toolbox.metrics
+
+
+SCENARIOS = ["log_sample", "log_sample_by_idx", "finish_samples", "legacy", "memory"]
+
+def process_options():
+    parser = argparse.ArgumentParser(description="Benchmark the CDM metric-data writers")
+
+    parser.add_argument("--scenario",
+                        dest = "scenarios",
+                        help = "Scenario to run, may be given several times (default: all of them)",
+                        action = "append",
+                        choices = SCENARIOS)
+
+    parser.add_argument("--metrics",
+                        dest = "metrics",
+                        help = "Number of metrics to log samples for",
+                        default = 1000,
+                        type = int)
+
+    parser.add_argument("--samples",
+                        dest = "samples",
+                        help = "Total number of samples to log, spread round-robin over the metrics",
+                        default = 1000000,
+                        type = int)
+
+    parser.add_argument("--churn",
+                        dest = "churn",
+                        help = "Fraction of samples whose value differs from the previous one (0.0 - 1.0)",
+                        default = 0.3,
+                        type = float)
+
+    parser.add_argument("--names",
+                        dest = "names",
+                        help = "Number of names per metric",
+                        default = 3,
+                        type = int)
+
+    parser.add_argument("--codec",
+                        dest = "codec",
+                        help = "Compression codec of the metric-data files (not used by the legacy scenario)",
+                        default = "xz",
+                        choices = ["xz", "gzip", "bz2", "zstd", "none"])
+
+    parser.add_argument("--level",
+                        dest = "level",
+                        help = "Compression level/preset (default: the codec's default)",
+                        default = None,
+                        type = int)
+
+    parser.add_argument("--save",
+                        dest = "save",
+                        help = "Write the results to this JSON file",
+                        default = None,
+                        type = str)
+
+    parser.add_argument("--compare",
+                        dest = "compare",
+                        help = "Compare the results with a JSON file written by --save",
+                        default = None,
+                        type = str)
+
+    parser.add_argument("--threshold",
+                        dest = "threshold",
+                        help = "Exit with an error if a rate drops by more than this many percent vs --compare",
+                        default = 10.0,
+                        type = float)
+
+    parser.add_argument("--run-scenario",
+                        dest = "run_scenario",
+                        help = argparse.SUPPRESS,
+                        default = None,
+                        choices = SCENARIOS)
+
+    return parser.parse_args()
+
+
+def make_names(args, i):
+    return {"name%d" % n: "%d-%d" % (n, i) for n in range(args.names)}
+
+
+def make_workload(args):
+    """Return (desc, names, steps, changes) for the throughput scenarios.
+
+    changes is a repeating pattern of booleans, True for the samples
+    whose value must change, with args.churn of them set.
+    """
+    desc = {"class": "throughput", "source": "bench", "type": "packets-sec"}
+    names = [make_names(args, i) for i in range(args.metrics)]
+    steps = max(args.samples // args.metrics, 1)
+    period = 4099
+    changes = [(k * 2654435761 % period) < args.churn * period for k in range(period)]
+    return desc, names, steps, changes
+
+
+def output_bytes(path):
+    total = 0
+    for entry in os.scandir(path):
+        total += entry.stat().st_size
+    return total
+
+
+def bench_memory(args, log_sample):
+    """Return the bytes traced per registered metric.
+
+    Every metric is logged twice so that its begin/interval state is
+    populated too. The names dicts are built up front and are not
+    counted, since their values belong to the caller.
+    """
+    desc = {"class": "throughput", "source": "bench", "type": "memory"}
+    names = [make_names(args, i) for i in range(args.metrics)]
+    # The first sample opens the compressed output stream; keep its
+    # buffers out of the measurement.
+    log_sample("0", desc, {"name": "warmup"}, {"end": 1000, "value": 0})
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for end in (2000, 3000):
+        for i in range(args.metrics):
+            log_sample("0", desc, names[i], {"end": end, "value": i % 7 + 0.5})
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / args.metrics
+
+
+def log_workload(args, log_sample, by_idx=None):
+    """Log the workload with log_sample(), or with by_idx() after the first step.
+
+    Returns the number of samples logged.
+    """
+    desc, names, steps, changes = make_workload(args)
+    values = [1000] * args.metrics
+    idxs = []
+    period = len(changes)
+    k = 0
+    for step in range(steps):
+        end = 15000 + step * 1000
+        for i in range(args.metrics):
+            if changes[k]:
+                values[i] += 1
+            k = (k + 1) % period
+            if by_idx is not None and step > 0:
+                by_idx(idxs[i], values[i], end)
+            elif by_idx is not None:
+                idxs.append(log_sample("0", desc, names[i], {"end": end, "value": values[i]}))
+            else:
+                log_sample("0", desc, names[i], {"end": end, "value": values[i]})
+    return steps * args.metrics
+
+
+def run_scenario(args, scenario, output_dir):
+    """Run one scenario in this process and return its result dict."""
+    result = {"scenario": scenario, "unit": "samples/s"}
+    if scenario == "memory":
+        cdm = CDMMetrics(output_dir, codec=args.codec, level=args.level)
+        result["bytes_per_metric"] = bench_memory(args, cdm.log_sample)
+        cdm.finish_samples()
+        result["unit"] = None
+    elif scenario == "legacy":
+        toolbox.metrics.output_dir = output_dir
+        start = time.perf_counter()
+        result["samples"] = log_workload(args, toolbox.metrics.log_sample)
+        toolbox.metrics.finish_samples()
+        result["seconds"] = time.perf_counter() - start
+    else:
+        cdm = CDMMetrics(output_dir, codec=args.codec, level=args.level)
+        if scenario == "finish_samples":
+            # only the final flush and compression are timed
+            result["samples"] = log_workload(args, cdm.log_sample)
+            result["unit"] = "metrics/s"
+            start = time.perf_counter()
+            cdm.finish_samples()
+            result["seconds"] = time.perf_counter() - start
+        else:
+            by_idx = cdm.log_sample_by_idx if scenario == "log_sample_by_idx" else None
+            start = time.perf_counter()
+            result["samples"] = log_workload(args, cdm.log_sample, by_idx)
+            cdm.finish_samples()
+            result["seconds"] = time.perf_counter() - start
+    if "seconds" in result:
+        count = args.metrics if scenario == "finish_samples" else result["samples"]
+        result["rate"] = count / result["seconds"]
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["output_bytes"] = output_bytes(output_dir)
+    return result
+
+
+def run_child(scenario):
+    """Run a scenario in a fresh interpreter so that its peak RSS is its own."""
+    cmd = [sys.executable, __file__, "--run-scenario", scenario,
+           "--metrics", str(args.metrics), "--samples", str(args.samples),
+           "--churn", str(args.churn), "--names", str(args.names), "--codec", args.codec]
+    if args.level is not None:
+        cmd += ["--level", str(args.level)]
+    child = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, text=True)
+    return json.loads(child.stdout)
+
+
+def print_result(result, baseline=None):
+    if result["scenario"] == "memory":
+        line = "%-18s %10.1f bytes/metric" % (result["scenario"], result["bytes_per_metric"])
+    else:
+        line = "%-18s %10.0f %-9s %8.3fs" % (result["scenario"], result["rate"], result["unit"], result["seconds"])
+    line += " %8d KiB peak RSS %10d output bytes" % (result["peak_rss_kb"], result["output_bytes"])
+    if baseline is not None and "rate" in result:
+        line += " %+6.1f%%" % ((result["rate"] / baseline["rate"] - 1) * 100)
+    print(line)
+
+
+def main():
+    if args.run_scenario is not None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            print(json.dumps(run_scenario(args, args.run_scenario, os.path.join(tmp_dir, "postprocess"))))
+        return 0
+
+    baselines = {}
+    if args.compare is not None:
+        with open(args.compare) as fh:
+            baselines = {result["scenario"]: result for result in json.load(fh)["results"]}
+
+    print("%d metrics, %d samples, churn %.2f, codec %s level %s" %
+          (args.metrics, args.samples, args.churn, args.codec, args.level))
+    results = []
+    regressions = []
+    for scenario in args.scenarios or SCENARIOS:
+        result = run_child(scenario)
+        baseline = baselines.get(scenario)
+        print_result(result, baseline)
+        results.append(result)
+        if baseline is not None and "rate" in result and \
+           result["rate"] < baseline["rate"] * (1 - args.threshold / 100):
+            regressions.append(scenario)
+
+    if args.save is not None:
+        with open(args.save, "w") as fh:
+            json.dump({"args": {"metrics": args.metrics, "samples": args.samples, "churn": args.churn,
+                                "names": args.names, "codec": args.codec, "level": args.level},
+                       "results": results}, fh, indent=2)
+
+    if regressions:
+        print("ERROR: more than %.1f%% slower than %s: %s" % (args.threshold, args.compare, ", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    args = process_options()
+    exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import argparse
+from pathlib import Path
+
+import sys
+import os
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.cdm_merge import merge_metric_data
+
+
+def process_options():
+    parser = argparse.ArgumentParser(description="Merge several metric-data files into one")
+
+    parser.add_argument("inputs",
+                        help = "metric-data file paths without extensions, e.g. postprocess/metric-data-0, oldest first",
+                        nargs = "+")
+
+    parser.add_argument("--output-dir",
+                        dest = "output_dir",
+                        help = "Directory to write the merged metric-data files to",
+                        required = True,
+                        type = str)
+
+    parser.add_argument("--file-id",
+                        dest = "file_id",
+                        help = "The id of the merged file (metric-data-<id>)",
+                        default = "0",
+                        type = str)
+
+    parser.add_argument("--codec",
+                        dest = "codec",
+                        help = "Compression codec of the merged files",
+                        default = "xz",
+                        choices = ["xz", "gzip", "bz2", "zstd", "none"])
+
+    parser.add_argument("--level",
+                        dest = "level",
+                        help = "Compression level/preset (default: the codec's default)",
+                        default = None,
+                        type = int)
+
+    return parser.parse_args()
+
+
+def main():
+    try:
+        prefix = merge_metric_data(args.inputs, args.output_dir, args.file_id, args.codec, args.level)
+    except (FileNotFoundError, ValueError) as e:
+        print("ERROR: %s" % (e))
+        return 1
+    print(os.path.join(args.output_dir, prefix))
+    return 0
+
+if __name__ == "__main__":
+    args = process_options()
+    exit(main())
@@ -0,0 +1,109 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from toolbox.cdm_metrics import CDMMetrics
+
+
+class AsyncCDMMetrics:
+    """asyncio facade over a CDMMetrics.
+
+    Samples logged from the event loop are collected in batches of
+    batch_size and applied to the CDMMetrics by a single worker thread,
+    so neither the consolidation nor the compression and file I/O behind
+    it (nor the JSON dump of finish_samples()) runs on the event loop.
+    Batches are applied in order. At most max_pending batches are in
+    flight; logging more waits for the oldest one, which bounds the
+    memory used for buffering when the writer cannot keep up.
+
+    cdm is the CDMMetrics to wrap; when None one is created from
+    cdm_kwargs. It must not be used directly while the facade is open.
+    The desc, names and sample dicts are used when the batch is applied,
+    so they must not be modified after being passed in.
+    log_sample() does not return the metric idx (the sample is only
+    applied later); use register_metric() to get an idx for
+    log_sample_by_idx(). An error raised while applying a batch is
+    re-raised by the call that waits for that batch: a later log call,
+    flush(), finish_samples() or close().
+    """
+
+    def __init__(self, cdm=None, batch_size=1024, max_pending=8, **cdm_kwargs):
+        self.cdm = cdm if cdm is not None else CDMMetrics(**cdm_kwargs)
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cdm-metrics")
+        self._batch = []
+        self._pending = deque()
+
+    def _apply(self, batch):
+        log_sample = self.cdm.log_sample
+        log_sample_by_idx = self.cdm.log_sample_by_idx
+        for by_idx, args in batch:
+            if by_idx:
+                log_sample_by_idx(*args)
+            else:
+                log_sample(*args)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _submit(self):
+        batch = self._batch
+        self._batch = []
+        self._pending.append(asyncio.get_running_loop().run_in_executor(self._executor, self._apply, batch))
+        while len(self._pending) > self.max_pending:
+            await self._pending.popleft()
+
+    async def log_sample(self, file_id, desc, names, sample):
+        """Queue a sample, see CDMMetrics.log_sample(). Returns nothing."""
+        self._batch.append((False, (file_id, desc, names, sample)))
+        if len(self._batch) >= self.batch_size:
+            await self._submit()
+
+    async def log_sample_by_idx(self, idx, value, end, begin=None, file_id=None):
+        """Queue a sample of a known metric idx, see CDMMetrics.log_sample_by_idx()."""
+        self._batch.append((True, (idx, value, end, begin, file_id)))
+        if len(self._batch) >= self.batch_size:
+            await self._submit()
+
+    async def flush(self):
+        """Wait until every queued sample has been applied."""
+        if self._batch:
+            await self._submit()
+        while self._pending:
+            await self._pending.popleft()
+
+    async def register_metric(self, desc, names, file_id=None):
+        """Register a metric after the queued samples; returns its idx."""
+        await self.flush()
+        return await self._run(self.cdm.register_metric, desc, names, file_id)
+
+    async def finish_samples(self, dont_delete=False, file_id=None):
+        """Apply the queued samples, then finish one file in the worker thread."""
+        await self.flush()
+        return await self._run(self.cdm.finish_samples, dont_delete, file_id)
+
+    async def finish_all_samples(self, dont_delete=False, max_workers=None):
+        """Apply the queued samples, then finish every file in the worker thread."""
+        await self.flush()
+        return await self._run(self.cdm.finish_all_samples, dont_delete, max_workers)
+
+    async def close(self):
+        """Apply the queued samples and stop the worker thread.
+
+        Open files are not finished; call finish_samples() or
+        finish_all_samples() first.
+        """
+        try:
+            await self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,246 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+"""Binary columnar format for CDM metric data.
+
+A file starts with an 8 byte header (magic "CDMB", uint16 version,
+uint16 block codec) followed by blocks. Each block is an 8 byte block
+header (uint32 record count, uint32 payload size) and a payload holding
+the block's records column by column: int64 begin[], int64 end[],
+float64 value[], uint32 idx[], zero padded to a multiple of 8 bytes and
+then compressed with the block codec. Everything is little-endian.
+
+Every block can be decompressed on its own, and with codec "none" the
+columns can be used in place from an mmap of the file. Values are
+stored as float64, so integer values read back as floats; begin and
+end must be integers.
+"""
+
+import bz2
+import lzma
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+
+from toolbox.fileio import COMPRESSION_EXTENSIONS, _CountedFile, open_read_text_file, open_write_text_file, zstd
+
+
+BINARY_MAGIC = b"CDMB"
+BINARY_VERSION = 1
+
+_HEADER = struct.Struct("<4sHH")
+_BLOCK_HEADER = struct.Struct("<II")
+_CODEC_IDS = {"none": 0, "xz": 1, "gzip": 2, "bz2": 3, "zstd": 4}
+_CODEC_NAMES = {codec_id: codec for codec, codec_id in _CODEC_IDS.items()}
+_COLUMN_TYPES = ("q", "q", "d", "I")
+# uncompressed bytes of one record, over all the columns
+RECORD_SIZE = sum(struct.calcsize("<" + typecode) for typecode in _COLUMN_TYPES)
+
+
+def _compress(codec, level, data):
+    if codec == "xz":
+        return lzma.compress(data, preset=level)
+    if codec == "gzip":
+        return zlib.compress(data, -1 if level is None else level)
+    if codec == "bz2":
+        return bz2.compress(data, 9 if level is None else level)
+    if codec == "zstd":
+        if zstd is None:
+            raise ValueError("zstd codec requested but neither compression.zstd nor zstandard is available")
+        if zstd.__name__ == "zstandard":
+            return zstd.ZstdCompressor(level=3 if level is None else level).compress(data)
+        return zstd.compress(data, level)
+    return data
+
+
+def _decompress(codec, data):
+    if codec == "xz":
+        return lzma.decompress(data)
+    if codec == "gzip":
+        return zlib.decompress(data)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    if codec == "zstd":
+        if zstd is None:
+            raise ValueError("zstd compressed file but neither compression.zstd nor zstandard is available")
+        if zstd.__name__ == "zstandard":
+            return zstd.ZstdDecompressor().decompress(data)
+        return zstd.decompress(data)
+    return data
+
+
+def _padding(size):
+    return -size % 8
+
+
+class BinaryMetricWriter:
+    """Write (idx, begin, end, value) records to a binary metric-data file.
+
+    Records are buffered in column arrays and written as one block every
+    block_records records, compressed with codec/level (any codec of
+    toolbox.fileio.COMPRESSION_EXTENSIONS). io_counter, a
+    toolbox.fileio.IOCounter, accumulates the bytes written to the file
+    and the time spent writing them.
+    """
+
+    def __init__(self, filename, codec="xz", level=None, block_records=65536, io_counter=None):
+        if codec not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unknown compression codec '{codec}'")
+        self.filename = filename
+        self.codec = codec
+        self.level = level
+        self.block_records = block_records
+        self.fh = open(filename, "wb")
+        if io_counter is not None:
+            self.fh = _CountedFile(self.fh, io_counter)
+        self.fh.write(_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, _CODEC_IDS[codec]))
+        self._new_columns()
+
+    def _new_columns(self):
+        self._begins = array("q")
+        self._ends = array("q")
+        self._values = array("d")
+        self._idxs = array("I")
+
+    @property
+    def closed(self):
+        return self.fh is None
+
+    def write_sample(self, idx, begin, end, value):
+        self._begins.append(begin)
+        self._ends.append(end)
+        self._values.append(value)
+        self._idxs.append(idx)
+        if len(self._idxs) >= self.block_records:
+            self.flush_block()
+
+    def flush_block(self):
+        num = len(self._idxs)
+        if num == 0:
+            return
+        columns = (self._begins, self._ends, self._values, self._idxs)
+        if sys.byteorder != "little":
+            for column in columns:
+                column.byteswap()
+        payload = b"".join(column.tobytes() for column in columns)
+        payload += bytes(_padding(len(payload)))
+        payload = _compress(self.codec, self.level, payload)
+        self.fh.write(_BLOCK_HEADER.pack(num, len(payload)))
+        self.fh.write(payload)
+        if self.codec != "none":
+            # keep blocks 8 byte aligned in the file as well
+            self.fh.write(bytes(_padding(len(payload))))
+        self._new_columns()
+
+    def close(self):
+        if self.fh is None:
+            return
+        self.flush_block()
+        self.fh.close()
+        self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_binary_blocks(filename):
+    """Yield the (begins, ends, values, idxs) column arrays of each block.
+
+    For codec "none" files the columns are memoryviews into an mmap of
+    the file, so no data is copied; they are released when the next
+    block is requested. Otherwise they are arrays holding the
+    decompressed block.
+    """
+    with open(filename, "rb") as fh:
+        header = fh.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{filename} is not a binary metric-data file")
+        magic, version, codec_id = _HEADER.unpack(header)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION or codec_id not in _CODEC_NAMES:
+            raise ValueError(f"{filename} is not a binary metric-data file (version {BINARY_VERSION})")
+        codec = _CODEC_NAMES[codec_id]
+        if codec == "none":
+            yield from _iter_mapped_blocks(fh)
+            return
+        while True:
+            block_header = fh.read(_BLOCK_HEADER.size)
+            if not block_header:
+                return
+            num, size = _BLOCK_HEADER.unpack(block_header)
+            payload = _decompress(codec, fh.read(size))
+            fh.seek(_padding(size), 1)
+            columns = []
+            offset = 0
+            for typecode in _COLUMN_TYPES:
+                column = array(typecode)
+                column.frombytes(payload[offset:offset + num * column.itemsize])
+                if sys.byteorder != "little":
+                    column.byteswap()
+                offset += num * column.itemsize
+                columns.append(column)
+            yield tuple(columns)
+
+
+def _iter_mapped_blocks(fh):
+    if sys.byteorder != "little":
+        raise ValueError("mapping binary metric-data requires a little-endian host")
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            offset = _HEADER.size
+            while offset < len(view):
+                num, size = _BLOCK_HEADER.unpack_from(view, offset)
+                offset += _BLOCK_HEADER.size
+                columns = []
+                column_offset = offset
+                for typecode in _COLUMN_TYPES:
+                    itemsize = 4 if typecode == "I" else 8
+                    columns.append(view[column_offset:column_offset + num * itemsize].cast(typecode))
+                    column_offset += num * itemsize
+                try:
+                    yield tuple(columns)
+                finally:
+                    # the views must not outlive the mapping
+                    for column in columns:
+                        column.release()
+                offset += size
+
+
+def iter_binary_samples(filename):
+    """Yield (idx, begin, end, value) tuples from a binary metric-data file."""
+    for begins, ends, values, idxs in iter_binary_blocks(filename):
+        yield from zip(idxs.tolist(), begins.tolist(), ends.tolist(), values.tolist())
+
+
+def _format_value(value):
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def csv_to_binary(csv_file, binary_file, codec="xz", level=None, block_records=65536):
+    """Convert a metric-data csv (any supported compression) to the binary format."""
+    fh, _ = open_read_text_file(csv_file)
+    with fh, BinaryMetricWriter(binary_file, codec, level, block_records) as writer:
+        for line in fh:
+            idx, begin, end, value = line.split(",")
+            writer.write_sample(int(idx), int(begin), int(end), float(value))
+    return binary_file
+
+
+def binary_to_csv(binary_file, csv_file, codec="xz", level=None):
+    """Convert a binary metric-data file back to csv.
+
+    Integral values are written as integers, others as Python floats.
+    Returns the actual csv filename (see open_write_text_file()).
+    """
+    fh, csv_file = open_write_text_file(csv_file, codec, level)
+    with fh:
+        for begins, ends, values, idxs in iter_binary_blocks(binary_file):
+            fh.write("".join(
+                str(idx) + "," + str(begin) + "," + str(end) + "," + _format_value(value) + "\n"
+                for idx, begin, end, value in zip(idxs.tolist(), begins.tolist(), ends.tolist(), values.tolist())
+            ))
+    return csv_file
@@ -0,0 +1,117 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import queue
+import threading
+
+from toolbox.cdm_metrics import POSTPROCESS_DIR, CDMMetrics
+from toolbox.cdm_reader import MetricDataReader
+
+
+_END = object()
+
+
+class _ReadAhead:
+    """Iterate over the samples of a MetricDataReader, read by a background thread.
+
+    The thread starts right away and decompresses and parses up to
+    max_batches batches of batch_size samples ahead of the consumer.
+    lzma/zlib/bz2 release the GIL while decompressing, so several inputs
+    read this way decompress on several cores. close() stops the thread.
+    """
+
+    def __init__(self, reader, batch_size, max_batches):
+        self._batches = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(reader, batch_size),
+                                        name="read-" + reader.path_prefix, daemon=True)
+        self._thread.start()
+
+    def _produce(self, reader, batch_size):
+        try:
+            batch = []
+            for sample in reader.samples():
+                batch.append(sample)
+                if len(batch) >= batch_size:
+                    self._batches.put(batch)
+                    batch = []
+                    if self._stop.is_set():
+                        return
+            if batch:
+                self._batches.put(batch)
+            self._batches.put(_END)
+        except Exception as exc:
+            self._batches.put(exc)
+
+    def __iter__(self):
+        while True:
+            batch = self._batches.get()
+            if batch is _END:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+
+    def close(self):
+        self._stop.set()
+        # unblock the producer if the consumer stopped early
+        while self._thread.is_alive():
+            try:
+                self._batches.get_nowait()
+            except queue.Empty:
+                self._thread.join(0.01)
+
+
+def merge_metric_data(path_prefixes, output_dir=POSTPROCESS_DIR, file_id="0", codec="xz", level=None,
+                      batch_size=4096, read_ahead=4):
+    """Merge several metric-data files into one metric-data-<file_id> pair.
+
+    path_prefixes are metric-data file paths without their extensions
+    (any format MetricDataReader reads). Metrics with the same desc and
+    names in several inputs become one metric, idx values are renumbered
+    in input order, and the samples of each metric are re-consolidated,
+    so adjacent equal samples coming from different inputs are joined.
+
+    The rows of a metric-data file are only in time order per metric
+    (a row is written when its metric's value changes), so the inputs
+    are not interleaved: they are streamed one after another, in the
+    given order. A metric that is present in several inputs must cover
+    disjoint time ranges in them, in that order (e.g. one input per time
+    slice, oldest first); otherwise its samples overlap and ValueError
+    is raised. Every input is decompressed by its own reader thread,
+    at most read_ahead batches of batch_size samples ahead, so the next
+    inputs are being decompressed while the current one is merged.
+
+    Returns the prefix of the merged file (see CDMMetrics.finish_samples()).
+    """
+    readers = [MetricDataReader(prefix) for prefix in path_prefixes]
+    cdm = CDMMetrics(output_dir, codec=codec, level=level)
+    # (input number, input idx) -> merged idx, registered in input order
+    mapping = []
+    for reader in readers:
+        mapping.append({
+            idx: cdm.register_metric(metric["desc"], metric["names"], file_id)
+            for idx, metric in sorted(reader.metric_types.items())
+        })
+
+    streams = [_ReadAhead(reader, batch_size, read_ahead) for reader in readers]
+    try:
+        last_end = {}
+        log_sample_by_idx = cdm.log_sample_by_idx
+        for n, stream in enumerate(streams):
+            for sample in stream:
+                idx = mapping[n][sample.idx]
+                previous = last_end.get(idx)
+                if previous is not None and sample.begin <= previous:
+                    raise ValueError(
+                        f"Samples of metric {readers[n].metric_types[sample.idx]} overlap in time "
+                        f"({path_prefixes[n]} at {sample.begin}-{sample.end}); the inputs must "
+                        f"cover disjoint time ranges, given in time order"
+                    )
+                last_end[idx] = sample.end
+                log_sample_by_idx(idx, sample.value, sample.end, sample.begin, file_id)
+    finally:
+        for stream in streams:
+            stream.close()
+    # every input metric had samples, so none of them is purged
+    return cdm.finish_samples(dont_delete=True, file_id=file_id)
@@ -2,11 +2,236 @@
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
 import json
-import lzma
+import logging
+import operator
 import os
+import time
+from array import array
+from collections import namedtuple
+from itertools import compress, count, islice
 
+from toolbox.cdm_binary import RECORD_SIZE, BinaryMetricWriter
+from toolbox.fileio import COMPRESSION_EXTENSIONS, BackgroundWriter, IOCounter, open_write_text_file
+from toolbox.parallel import run_parallel_jobs
+from toolbox.xz import DEFAULT_BLOCK_SIZE, XZBlockWriter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
 
 POSTPROCESS_DIR = "postprocess"
+CHECKPOINT_VERSION = 1
+
+Deadband = namedtuple("Deadband", ["abs_tolerance", "rel_tolerance", "max_span"], defaults=(0, 0, None))
+
+
+def _check_deadband(deadband):
+    if deadband is None:
+        return None
+    deadband = Deadband(*deadband)
+    if deadband.abs_tolerance < 0 or deadband.rel_tolerance < 0:
+        raise ValueError(f"deadband tolerances must not be negative: {deadband}")
+    if deadband.max_span is not None and deadband.max_span < 0:
+        raise ValueError(f"deadband max_span must not be negative: {deadband}")
+    return deadband
+
+
+def _change_points(values, start):
+    """Return the positions k >= start where values[k] != values[k - 1].
+
+    NumPy arrays are compared in one vectorized operation; any other
+    sequence is compared pairwise in C via map/compress.
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        tail = values[start - 1:]
+        return (numpy.flatnonzero(tail[1:] != tail[:-1]) + start).tolist()
+    return list(compress(
+        count(start),
+        map(operator.ne, islice(values, start, None), islice(values, start - 1, None)),
+    ))
+
+
+def _as_list(seq):
+    """Convert an array.array/NumPy array to a list of Python scalars."""
+    if isinstance(seq, list):
+        return seq
+    if hasattr(seq, "tolist"):
+        return seq.tolist()
+    return list(seq)
+
+
+def _canonical_key(key):
+    """Normalize names values of a metric key the way the metric label does."""
+    source, type_, sorted_keys, values = key
+    return (source, type_, sorted_keys, tuple(str(value) if value else "x" for value in values))
+
+
+class _MetricFile:
+    """Per-file_id state: the open metric-data stream and its metrics.
+
+    Per-metric data is kept in parallel columns indexed by metric idx
+    instead of one dict per metric, which keeps the resident cost of a
+    registered metric to a few list slots. The stored (not yet written)
+    sample of metric idx is (begins[idx], ends[idx], values[idx]); a
+    begin or interval of None means it is not known yet. Names are kept
+    as a tuple of values plus an interned tuple of keys, and identical
+    descs are shared between metrics.
+    """
+
+    __slots__ = (
+        "file_id", "prefix", "fh", "binary", "index", "metric_idx", "descs", "name_keys", "name_values",
+        "begins", "ends", "values", "intervals", "num_written", "deadbands", "rollups", "stats",
+    )
+
+    def __init__(self, file_id, fh, binary=False):
+        self.file_id = file_id
+        self.prefix = "metric-data-" + file_id
+        self.fh = fh
+        self.binary = binary
+        self.index = None
+        self.metric_idx = {}
+        self.descs = []
+        self.name_keys = []
+        self.name_values = []
+        self.begins = []
+        self.ends = []
+        self.values = []
+        self.intervals = []
+        self.num_written = array("Q")
+        self.deadbands = {}
+        self.rollups = None
+        self.stats = None
+
+    def __len__(self):
+        return len(self.ends)
+
+
+class _Rollup:
+    """Rollup state of one interval of a _MetricFile.
+
+    buckets maps a metric idx to its partially filled bucket:
+    [bucket number, first begin, last end, time-weighted value sum,
+    min, max].
+    """
+
+    __slots__ = ("interval", "fh", "buckets")
+
+    def __init__(self, interval, fh):
+        self.interval = interval
+        self.fh = fh
+        self.buckets = {}
+
+    @staticmethod
+    def _format(idx, begin, end, avg, minimum, maximum):
+        return (str(idx) + "," + str(begin) + "," + str(end) + "," + str(avg) + ","
+                + str(minimum) + "," + str(maximum) + "\n")
+
+    def _emit(self, idx, bucket, lines):
+        _, begin, end, total, minimum, maximum = bucket
+        lines.append(self._format(idx, begin, end, total / (end - begin + 1), minimum, maximum))
+
+    def add_rows(self, idx, rows):
+        """Add the (begin, end, value) rows of idx, in time order."""
+        interval = self.interval
+        bucket = self.buckets.get(idx)
+        lines = []
+        for begin, end, value in rows:
+            while begin <= end:
+                number = (begin - 1) // interval
+                bucket_end = (number + 1) * interval
+                if bucket is not None and bucket[0] != number:
+                    self._emit(idx, bucket, lines)
+                    bucket = None
+                if bucket is None and begin == bucket_end - interval + 1 and end >= bucket_end:
+                    # whole buckets covered by one constant row make one rollup row
+                    span_end = begin - 1 + (end - begin + 1) // interval * interval
+                    lines.append(self._format(idx, begin, span_end, value, value, value))
+                    begin = span_end + 1
+                    continue
+                span_end = min(end, bucket_end)
+                weight = (span_end - begin + 1) * value
+                if bucket is None:
+                    bucket = [number, begin, span_end, weight, value, value]
+                else:
+                    bucket[2] = span_end
+                    bucket[3] += weight
+                    if value < bucket[4]:
+                        bucket[4] = value
+                    if value > bucket[5]:
+                        bucket[5] = value
+                if span_end == bucket_end:
+                    self._emit(idx, bucket, lines)
+                    bucket = None
+                begin = span_end + 1
+        if bucket is None:
+            self.buckets.pop(idx, None)
+        else:
+            self.buckets[idx] = bucket
+        if lines:
+            self.fh.write("".join(lines))
+
+    def close(self):
+        """Write the partially filled buckets and close the file."""
+        lines = []
+        for idx in sorted(self.buckets):
+            self._emit(idx, self.buckets[idx], lines)
+        self.buckets = {}
+        if lines:
+            self.fh.write("".join(lines))
+        self.fh.close()
+
+
+class _Stats:
+    """Running statistics of the metrics of a _MetricFile.
+
+    run_counts[idx] is the number of logged samples in the stored (not
+    yet written) sample of idx; metrics maps idx to [count, rows, begin,
+    end, min, max, sum, weighted sum, duration] once a row of it has
+    been written.
+    """
+
+    __slots__ = ("run_counts", "metrics")
+
+    def __init__(self):
+        self.run_counts = array("Q")
+        self.metrics = {}
+
+    def add_row(self, idx, begin, end, value):
+        samples = self.run_counts[idx]
+        self.run_counts[idx] = 0
+        duration = end - begin + 1
+        stats = self.metrics.get(idx)
+        if stats is None:
+            self.metrics[idx] = [samples, 1, begin, end, value, value, samples * value, duration * value, duration]
+            return
+        stats[0] += samples
+        stats[1] += 1
+        stats[3] = end
+        if value < stats[4]:
+            stats[4] = value
+        if value > stats[5]:
+            stats[5] = value
+        stats[6] += samples * value
+        stats[7] += duration * value
+        stats[8] += duration
+
+    def summary(self, idx):
+        count, rows, begin, end, minimum, maximum, total, weighted, duration = self.metrics[idx]
+        return {
+            "count": count,
+            "rows": rows,
+            "begin": begin,
+            "end": end,
+            "min": minimum,
+            "max": maximum,
+            "mean": total / count if count else None,
+            "weighted_avg": weighted / duration if duration else None,
+            "duration": duration,
+        }
 
 
 class CDMMetrics:
@@ -14,69 +239,382 @@ class CDMMetrics:
 
     Each instance maintains its own state, so multiple threads or
     processes can each have their own CDMMetrics without conflicts.
+
+    State is kept per file_id, so one instance can stream samples for
+    several metric-data files at once (e.g. one per host or per CPU) and
+    finish them one at a time with finish_samples(file_id=...) or all
+    together with finish_all_samples().
+
+    With background_writer=True the metric-data rows are buffered in
+    memory and compressed/written by a dedicated thread (see
+    toolbox.fileio.BackgroundWriter), with at most writer_queue_size
+    buffered chunks in flight. finish_samples() flushes and closes it.
+
+    codec and level select the compression of the metric-data files
+    (see toolbox.fileio.open_write_text_file); the default is xz at its
+    default preset, e.g. codec="xz", level=1 trades ratio for speed.
+
+    output_format="binary" writes the samples to metric-data-<id>.bin in
+    the block-compressed columnar format of toolbox.cdm_binary instead
+    of the csv text format. The JSON descriptor is the same for both.
+
+    index=True (csv output with the xz codec only) writes the csv as
+    independently decompressible xz blocks of about block_size bytes and
+    finish_samples() adds a metric-data-<id>.index.json.xz sidecar. It
+    lists every block (compressed offset, unpadded size, uncompressed
+    offset and size) and, per metric idx, the blocks holding its samples
+    with their first begin and last end, so a reader can fetch just the
+    blocks covering a metric and time range.
+
+    deadband enables lossy consolidation: a Deadband(abs_tolerance,
+    rel_tolerance, max_span) (or a tuple of the same) applied to every
+    metric, which set_deadband() can override per metric. A sample whose
+    value differs from the stored one by at most abs_tolerance, or by at
+    most rel_tolerance * abs(stored value), extends the stored sample
+    instead of starting a new one, as long as the result does not span
+    more than max_span (end - begin; None means no limit). The stored
+    value is the first value of the run, so every logged sample is
+    within that tolerance of the value written for it. Without a
+    deadband only exactly equal values are consolidated.
+
+    rollups is a list of intervals (in the time unit of begin/end, e.g.
+    [10000, 60000] for 10s and 60s with millisecond timestamps). For each
+    interval a companion metric-data-<id>.rollup-<interval>.csv is
+    written in the same pass, with rows "idx,begin,end,avg,min,max":
+    the time-weighted average, minimum and maximum of metric idx over
+    the part of bucket begin..end it has samples for. Bucket k covers
+    k * interval + 1 to (k + 1) * interval; consecutive buckets in which
+    a metric has one constant value are written as a single row. The
+    idx refer to the metric-data JSON descriptor, and the rollups are
+    computed from the rows written to the metric-data file (so after
+    any deadband consolidation).
+
+    stats=True keeps running statistics of every metric and
+    finish_samples() writes them to a metric-data-<id>.stats.json
+    sidecar mapping each idx to its count (samples logged), rows
+    (samples written), begin, end, min, max, mean (of the logged
+    samples), weighted_avg (average over begin..end weighted by the
+    time each sample covers) and duration (the time covered), so
+    reports do not need another pass over the data. They describe the
+    written samples, so with a deadband min/max/mean/weighted_avg use
+    the value written for each consolidated run.
+
+    checkpoint_file enables checkpoints (csv output with the xz codec,
+    no background_writer, no rollups and no stats). The csv files are then written
+    as independent xz blocks like with index=True, and checkpoint()
+    closes the current block of every open file, fsyncs it and saves the
+    block list plus the complete in-memory state (metric table, stored
+    samples, counters) to checkpoint_file. After a crash a new instance
+    with the same arguments calls resume(), which truncates every file
+    to its last checkpointed block and restores the state, and then
+    skips the input up to the progress value saved with the checkpoint.
+    Each checkpoint ends the current xz block early, so checkpointing
+    very often costs compression ratio; checkpoint_interval (seconds)
+    makes checkpoint() skip calls that come sooner than that after the
+    previous one.
     """
 
-    def __init__(self, output_dir=POSTPROCESS_DIR):
+    def __init__(self, output_dir=POSTPROCESS_DIR, background_writer=False, writer_queue_size=8,
+                 codec="xz", level=None, output_format="csv", index=False, block_size=None, deadband=None,
+                 rollups=None, stats=False, checkpoint_file=None, checkpoint_interval=None):
+        if codec not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unknown compression codec '{codec}'")
+        if output_format not in ("csv", "binary"):
+            raise ValueError(f"Unknown output format '{output_format}', expected csv or binary")
+        if output_format == "binary" and background_writer:
+            raise ValueError("background_writer is only supported with the csv output format")
+        if index and (codec != "xz" or output_format != "csv" or background_writer):
+            raise ValueError("index requires the csv output format, the xz codec and no background_writer")
+        if checkpoint_file is not None and (codec != "xz" or output_format != "csv" or background_writer
+                                            or rollups or stats):
+            raise ValueError("checkpoint_file requires the csv output format, the xz codec, "
+                             "no background_writer, no rollups and no stats")
         self.output_dir = output_dir
-        self.metric_types = []
+        self.codec = codec
+        self.level = level
+        self.output_format = output_format
+        self.index = index
+        self.block_size = block_size if block_size is not None else DEFAULT_BLOCK_SIZE
+        self.deadband = _check_deadband(deadband)
+        self.rollups = sorted(set(rollups)) if rollups else []
+        if any(not isinstance(interval, int) or interval <= 0 for interval in self.rollups):
+            raise ValueError(f"rollups must be positive integer intervals: {rollups}")
+        self.stats = stats
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = None
+        self.background_writer = background_writer
+        self.writer_queue_size = writer_queue_size
+        self.files = {}
         self.file_id = None
-        self.metric_data_fh = {}
-        self.metric_idx = {}
-        self.stored_sample = {}
-        self.num_written_samples = {}
-        self.interval = {}
+        self._interned_descs = {}
+        self._name_orders = {}
+        self._current = None
         self.total_logged_samples = 0
         self.total_cons_samples = 0
         self.metric_data_file_prefix = ""
+        self._io_counter = None
         os.makedirs(self.output_dir, exist_ok=True)
 
-    def _get_metric_label(self, desc, names):
-        label = desc["source"] + ":" + desc["type"] + ":"
-        for name in sorted(names.keys()):
-            value = str(names[name]) if names[name] else "x"
-            label += "<" + name + ":" + value + ">"
-        return label
+    def _get_name_order(self, keys):
+        """Return (interned keys, sorted keys, getter) for a names key order.
 
-    def _write_sample(self, idx, begin, end, value):
-        if self.file_id is None:
-            raise RuntimeError("Cannot write sample because file_id is undefined")
-        if self.file_id not in self.metric_data_fh:
-            raise RuntimeError("Cannot write sample with undefined file handle: " + self.file_id)
-        self.metric_data_fh[self.file_id].write(
-            str(idx) + "," + str(begin) + "," + str(end) + "," + str(value) + "\n"
-        )
-        if idx not in self.num_written_samples:
-            self.num_written_samples[idx] = 1
+        getter reorders a tuple of names values into sorted-name order, or
+        is None when keys are already sorted. The result is cached, so
+        every names dict built with the same keys in the same order shares
+        one entry.
+        """
+        order = self._name_orders.get(keys)
+        if order is None:
+            sorted_keys = tuple(sorted(keys))
+            if sorted_keys == keys:
+                order = (keys, keys, None)
+            else:
+                order = (keys, sorted_keys, operator.itemgetter(*map(keys.index, sorted_keys)))
+            self._name_orders[keys] = order
+        return order
+
+    def _get_metric_key(self, desc, names):
+        """Return the lookup key of a metric and its names values.
+
+        The key is (source, type, sorted names, values in sorted-name
+        order). It is built from tuples with no sorting or string
+        formatting, so a repeat lookup costs a single hash probe. Keys
+        that differ only in how values are spelled in the metric label
+        (e.g. None vs "" vs "x", 1 vs "1") are mapped to the same metric
+        through _canonical_key().
+        """
+        keys, sorted_keys, getter = self._get_name_order(tuple(names))
+        values = tuple(names.values())
+        key = (desc["source"], desc["type"], sorted_keys, values if getter is None else getter(values))
+        return key, keys, values
+
+    def _lookup_metric(self, mf, desc, names):
+        """Return (idx, key, interned keys, values); idx is None when unregistered."""
+        key, keys, values = self._get_metric_key(desc, names)
+        try:
+            idx = mf.metric_idx.get(key)
+        except TypeError:
+            # Unhashable names values, only the canonical form can be looked up
+            key = _canonical_key(key)
+            idx = mf.metric_idx.get(key)
+        if idx is None:
+            canonical = _canonical_key(key)
+            if canonical != key:
+                idx = mf.metric_idx.get(canonical)
+                if idx is not None:
+                    mf.metric_idx[key] = idx
+        return idx, key, keys, values
+
+    def _get_file(self, file_id):
+        """Return the state for file_id, or the current file when None."""
+        if file_id is None:
+            if self._current is None:
+                raise RuntimeError("Cannot write sample because file_id is undefined")
+            return self._current
+        if file_id not in self.files:
+            raise RuntimeError("Cannot write sample with undefined file handle: " + file_id)
+        return self.files[file_id]
+
+    def _select_file(self, file_id):
+        """Make file_id the current file, opening its metric-data stream if needed."""
+        mf = self.files.get(file_id)
+        if mf is None:
+            metric_data_file = os.path.join(self.output_dir, "metric-data-" + file_id)
+            if self.output_format == "binary":
+                fh = BinaryMetricWriter(metric_data_file + ".bin", self.codec, self.level,
+                                        io_counter=self._io_counter)
+            else:
+                use_blocks = self.index or self.checkpoint_file is not None
+                fh, _ = open_write_text_file(metric_data_file + ".csv", self.codec, self.level,
+                                             self.block_size if use_blocks else None, self._io_counter)
+                if self.background_writer:
+                    fh = BackgroundWriter(fh, max_pending=self.writer_queue_size)
+            mf = _MetricFile(file_id, fh, self.output_format == "binary")
+            if self.index:
+                mf.index = {}
+            if self.rollups:
+                mf.rollups = []
+                for interval in self.rollups:
+                    rollup_fh, _ = open_write_text_file(
+                        metric_data_file + ".rollup-" + str(interval) + ".csv", self.codec, self.level,
+                        io_counter=self._io_counter,
+                    )
+                    if self.background_writer:
+                        rollup_fh = BackgroundWriter(rollup_fh, max_pending=self.writer_queue_size)
+                    mf.rollups.append(_Rollup(interval, rollup_fh))
+            if self.stats:
+                mf.stats = _Stats()
+            self.files[file_id] = mf
+        self.file_id = file_id
+        self._current = mf
+        self.metric_data_file_prefix = mf.prefix
+        return mf
+
+    def _index_rows(self, mf, idx, begin, end):
+        """Record that rows of idx spanning begin..end go to the current block."""
+        block = mf.fh.num_blocks
+        entries = mf.index.get(idx)
+        if entries is None:
+            mf.index[idx] = [[block, begin, end]]
+        elif entries[-1][0] != block:
+            entries.append([block, begin, end])
+        else:
+            entry = entries[-1]
+            entry[1] = min(entry[1], begin)
+            entry[2] = max(entry[2], end)
+
+    def _write_sample(self, mf, idx, begin, end, value):
+        if mf.index is not None:
+            self._index_rows(mf, idx, begin, end)
+        if mf.stats is not None:
+            mf.stats.add_row(idx, begin, end, value)
+        if mf.rollups is not None:
+            for rollup in mf.rollups:
+                rollup.add_rows(idx, ((begin, end, value),))
+        if mf.binary:
+            mf.fh.write_sample(idx, begin, end, value)
+        else:
+            mf.fh.write(
+                str(idx) + "," + str(begin) + "," + str(end) + "," + str(value) + "\n"
+            )
+        mf.num_written[idx] += 1
+
+    def _write_rows(self, mf, idx, rows):
+        """Write several (begin, end, value) rows of one metric at once."""
+        if mf.index is not None:
+            # a single write() is never split across blocks
+            self._index_rows(mf, idx, rows[0][0], rows[-1][1])
+        if mf.rollups is not None:
+            for rollup in mf.rollups:
+                rollup.add_rows(idx, rows)
+        if mf.binary:
+            for begin, end, value in rows:
+                mf.fh.write_sample(idx, begin, end, value)
         else:
-            self.num_written_samples[idx] += 1
+            prefix = str(idx) + ","
+            mf.fh.write("".join([
+                prefix + str(begin) + "," + str(end) + "," + str(value) + "\n"
+                for begin, end, value in rows
+            ]))
+        mf.num_written[idx] += len(rows)
 
-    def log_sample_by_idx(self, idx, value, end, begin=None):
-        """Fast path: update a known metric idx without label lookup.
+    def _intern(self, table, key, value):
+        """Return a shared copy of value for key, falling back to value if unhashable."""
+        try:
+            return table.setdefault(key, value)
+        except TypeError:
+            return value
+
+    def _register(self, mf, key, keys, values, desc, sample):
+        idx = len(mf.ends)
+        mf.metric_idx[key] = idx
+        canonical = _canonical_key(key)
+        if canonical != key:
+            mf.metric_idx[canonical] = idx
+        mf.descs.append(self._intern(self._interned_descs, tuple(desc.items()), desc.copy()))
+        mf.name_keys.append(keys)
+        mf.name_values.append(values)
+        if sample is None:
+            mf.begins.append(None)
+            mf.ends.append(None)
+            mf.values.append(None)
+        else:
+            mf.begins.append(sample.get("begin"))
+            mf.ends.append(sample["end"])
+            mf.values.append(sample["value"])
+        mf.intervals.append(None)
+        mf.num_written.append(0)
+        if mf.stats is not None:
+            mf.stats.run_counts.append(0 if sample is None else 1)
+        return idx
+
+    def register_metric(self, desc, names, file_id=None):
+        """Register a metric without logging a sample. Returns the metric idx.
+
+        file_id selects (and makes current) the file the metric belongs
+        to; when None the current file is used. If the metric is already
+        registered its existing idx is returned. The first sample can then
+        be logged with log_sample_by_idx(); a metric that never gets a
+        sample is left out of the output.
+        """
+        mf = self._get_file(None) if file_id is None else self._select_file(file_id)
+        idx, key, keys, values = self._lookup_metric(mf, desc, names)
+        if idx is None:
+            idx = self._register(mf, key, keys, values, desc, None)
+        return idx
+
+    def set_deadband(self, idx, deadband, file_id=None):
+        """Set the Deadband of metric idx, overriding the instance default.
+
+        Deadband(0, 0) turns lossy consolidation off for idx; None
+        reverts it to the instance default.
+        """
+        mf = self._get_file(file_id)
+        if not 0 <= idx < len(mf):
+            raise ValueError(f"Unknown metric idx {idx}")
+        deadband = _check_deadband(deadband)
+        if deadband is None:
+            mf.deadbands.pop(idx, None)
+        else:
+            mf.deadbands[idx] = deadband
 
-        Skips _get_metric_label and metric_idx lookup. The caller must have
-        obtained idx from a prior log_sample() call and must not change
-        file_id between log_sample() and calls here. begin is optional;
-        pass it only when the sample has an explicit start time.
+    def _get_deadband(self, mf, idx):
+        """Return the Deadband in effect for idx, or None for exact consolidation."""
+        return mf.deadbands.get(idx, self.deadband) if mf.deadbands else self.deadband
+
+    def _in_deadband(self, mf, idx, value, end):
+        deadband = self._get_deadband(mf, idx)
+        if deadband is None:
+            return False
+        if deadband.max_span is not None and end - mf.begins[idx] > deadband.max_span:
+            return False
+        stored = mf.values[idx]
+        delta = abs(value - stored)
+        return delta <= deadband.abs_tolerance or delta <= deadband.rel_tolerance * abs(stored)
+
+    def log_sample_by_idx(self, idx, value, end, begin=None, file_id=None):
+        """Fast path: update a known metric idx without any lookup.
+
+        The caller must have obtained idx from a prior log_sample() or
+        register_metric() call for the same file: either
+        pass that file_id, or leave it None and do not change file_id between
+        log_sample() and calls here. begin is optional; pass it only when the
+        sample has an explicit start time.
         Returns nothing.
         """
-        stored = self.stored_sample[idx]
-        if idx not in self.interval and stored["end"]:
-            self.interval[idx] = end - stored["end"]
-        if "begin" not in stored:
-            if idx in self.interval:
-                stored["begin"] = stored["end"] - self.interval[idx] + 1
+        mf = self._current if file_id is None else self._get_file(file_id)
+        if mf is None:
+            raise RuntimeError("Cannot write sample because file_id is undefined")
+        prev_end = mf.ends[idx]
+        if prev_end is None:
+            # First sample of a metric from register_metric()
+            mf.begins[idx] = begin
+            mf.ends[idx] = end
+            mf.values[idx] = value
+            if mf.stats is not None:
+                mf.stats.run_counts[idx] += 1
+            return
+        interval = mf.intervals[idx]
+        if interval is None and prev_end:
+            interval = mf.intervals[idx] = end - prev_end
+        if mf.begins[idx] is None:
+            if interval is not None:
+                mf.begins[idx] = prev_end - interval + 1
             else:
                 raise RuntimeError(
                     f"interval [{idx}] should have been defined, but it is not"
                 )
-        if stored["value"] != value:
-            self._write_sample(idx, stored["begin"], stored["end"], stored["value"])
+        if mf.values[idx] != value and (
+            (self.deadband is None and not mf.deadbands) or not self._in_deadband(mf, idx, value, end)
+        ):
+            self._write_sample(mf, idx, mf.begins[idx], prev_end, mf.values[idx])
             self.total_cons_samples += 1
-            stored["begin"] = begin if begin is not None else stored["end"] + 1
-            stored["end"] = end
-            stored["value"] = value
-        else:
-            stored["end"] = end
+            mf.begins[idx] = begin if begin is not None else prev_end + 1
+            mf.values[idx] = value
+        mf.ends[idx] = end
+        if mf.stats is not None:
+            mf.stats.run_counts[idx] += 1
         self.total_logged_samples += 1
 
     def log_sample(self, file_id, desc, names, sample):
@@ -86,75 +624,489 @@ class CDMMetrics:
         registered. On subsequent calls the stored sample is updated.
         Callers that call log_sample() in a tight loop with the same
         (desc, names) can cache the returned idx and call
-        log_sample_by_idx() directly to avoid repeated label computation.
+        log_sample_by_idx() directly to skip even the metric lookup.
         """
-        self.file_id = file_id
-        self.metric_data_file_prefix = "metric-data-" + file_id
-        metric_data_file = os.path.join(self.output_dir, self.metric_data_file_prefix + ".csv.xz")
-        label = self._get_metric_label(desc, names)
+        mf = self._current
+        if mf is None or mf.file_id != file_id:
+            mf = self._select_file(file_id)
+        idx, key, keys, values = self._lookup_metric(mf, desc, names)
 
-        if label in self.metric_idx:
-            idx = self.metric_idx[label]
+        if idx is not None:
             self.log_sample_by_idx(idx, sample["value"], sample["end"], sample.get("begin"))
             return idx
         else:
-            self.metric_idx[label] = len(self.metric_types)
-            idx = self.metric_idx[label]
-            self.metric_types.append({"desc": desc.copy(), "names": names.copy()})
-            if file_id not in self.metric_data_fh:
-                self.metric_data_fh[file_id] = lzma.open(metric_data_file, "wt")
-            self.stored_sample[idx] = sample.copy()
-            return idx
+            return self._register(mf, key, keys, values, desc, sample)
+
+    def log_samples(self, file_id, desc, names, ends, values, begins=None):
+        """Batch path: log a whole time-ordered series for one metric.
 
-    def finish_samples(self, dont_delete=False):
-        if self.file_id is None:
+        ends, values and the optional begins are equal-length sequences
+        (lists, array.array or NumPy arrays). Adjacent equal values are
+        consolidated in a single pass and the resulting metric-data is
+        identical to calling log_sample() once per element. An entry of
+        None in begins means "no explicit begin" for that sample.
+        Metrics with a deadband, and all metrics when stats are kept, are
+        consolidated one sample at a time, the same way
+        log_sample_by_idx() does.
+        Returns the metric idx, or None if the series is empty.
+        """
+        num = len(values)
+        if len(ends) != num or (begins is not None and len(begins) != num):
+            raise ValueError("ends, values and begins must all have the same length")
+        if num == 0:
             return None
 
-        num_deletes = 0
-        for idx in range(len(self.stored_sample)):
-            if self.file_id in self.metric_data_fh:
-                if (
-                    self.stored_sample[idx]["value"] == 0
-                    and idx not in self.num_written_samples
-                    and not dont_delete
-                ):
-                    self.metric_types[idx]["purge"] = 1
-                    num_deletes += 1
-                else:
-                    begin = self.stored_sample[idx].get("begin", self.stored_sample[idx]["end"])
-                    self._write_sample(
-                        idx,
-                        begin,
-                        self.stored_sample[idx]["end"],
-                        self.stored_sample[idx]["value"],
-                    )
-                    self.metric_types[idx]["idx"] = idx
+        change_values = values
+        ends = _as_list(ends)
+        values = _as_list(values)
+        if begins is not None:
+            begins = _as_list(begins)
 
-        self.stored_sample = {}
-        self.interval = {}
-        self.metric_idx = {}
+        # The first samples go through the scalar path, which handles
+        # registration and derivation of the initial begin from the interval.
+        start = 0
+        idx = None
+        while start < num:
+            if idx is None:
+                sample = {"end": ends[0], "value": values[0]}
+                if begins is not None and begins[0] is not None:
+                    sample["begin"] = begins[0]
+                idx = self.log_sample(file_id, desc, names, sample)
+                mf = self._current
+            else:
+                self.log_sample_by_idx(
+                    idx, values[start], ends[start],
+                    begins[start] if begins is not None else None,
+                )
+            start += 1
+            if mf.begins[idx] is not None:
+                break
+        if start >= num:
+            return idx
+
+        if self._get_deadband(mf, idx) is not None or mf.stats is not None:
+            for k in range(start, num):
+                self.log_sample_by_idx(idx, values[k], ends[k], begins[k] if begins is not None else None)
+            return idx
+
+        if mf.intervals[idx] is None and mf.ends[idx]:
+            mf.intervals[idx] = ends[start] - mf.ends[idx]
+
+        # Like log_sample_by_idx(), a run keeps its first value, which
+        # matters for values that compare equal but print differently
+        # (1 and 1.0).
+        run_begin = mf.begins[idx]
+        run_value = mf.values[idx]
+        rows = []
+        for k in _change_points(change_values, start):
+            rows.append((run_begin, ends[k - 1], run_value))
+            run_value = values[k]
+            if begins is not None and begins[k] is not None:
+                run_begin = begins[k]
+            else:
+                run_begin = ends[k - 1] + 1
+        if rows:
+            self._write_rows(mf, idx, rows)
+            self.total_cons_samples += len(rows)
 
-        if self.file_id in self.metric_data_fh:
-            self.metric_data_fh[self.file_id].close()
-            del self.metric_data_fh[self.file_id]
+        mf.begins[idx] = run_begin
+        mf.ends[idx] = ends[-1]
+        mf.values[idx] = run_value
+        self.total_logged_samples += num - start
+        return idx
 
+    def _finish_file(self, mf, dont_delete):
         new_metric_types = []
-        for idx in range(len(self.metric_types)):
-            if self.metric_types[idx].get("purge") == 1:
+        for idx in range(len(mf)):
+            if mf.ends[idx] is None:
                 continue
+            if mf.values[idx] == 0 and mf.num_written[idx] == 0 and not dont_delete:
+                continue
+            begin = mf.begins[idx]
+            self._write_sample(
+                mf,
+                idx,
+                begin if begin is not None else mf.ends[idx],
+                mf.ends[idx],
+                mf.values[idx],
+            )
             new_metric_types.append({
-                "idx": self.metric_types[idx]["idx"],
-                "desc": self.metric_types[idx]["desc"],
-                "names": self.metric_types[idx]["names"],
+                "idx": idx,
+                "desc": mf.descs[idx],
+                "names": dict(zip(mf.name_keys[idx], mf.name_values[idx])),
             })
 
+        mf.fh.close()
+        if mf.rollups is not None:
+            for rollup in mf.rollups:
+                rollup.close()
+
         if new_metric_types:
-            json_file = os.path.join(self.output_dir, "metric-data-" + self.file_id + ".json.xz")
-            with lzma.open(json_file, "wt") as fh:
+            json_file = os.path.join(self.output_dir, mf.prefix + ".json")
+            fh, _ = open_write_text_file(json_file, self.codec, self.level, io_counter=self._io_counter)
+            with fh:
                 json.dump(new_metric_types, fh)
 
-        prefix = self.metric_data_file_prefix
-        self.metric_types = []
-        self.file_id = None
-        self.num_written_samples = {}
+            if mf.index is not None:
+                index_file = os.path.join(self.output_dir, mf.prefix + ".index.json")
+                fh, _ = open_write_text_file(index_file, self.codec, self.level, io_counter=self._io_counter)
+                with fh:
+                    json.dump({
+                        "blocks": [list(block) for block in mf.fh.blocks],
+                        "metrics": {str(metric["idx"]): mf.index.get(metric["idx"], [])
+                                    for metric in new_metric_types},
+                    }, fh)
+
+            if mf.stats is not None:
+                stats_file = os.path.join(self.output_dir, mf.prefix + ".stats.json")
+                fh, _ = open_write_text_file(stats_file, self.codec, self.level, io_counter=self._io_counter)
+                with fh:
+                    json.dump({str(metric["idx"]): mf.stats.summary(metric["idx"])
+                               for metric in new_metric_types}, fh)
+
+        return mf.prefix
+
+    def checkpoint(self, progress=None, force=False):
+        """Save a checkpoint that resume() can continue from.
+
+        progress is any JSON-serializable value describing how far the
+        input has been processed (e.g. a byte offset or line number);
+        resume() returns it. Unless force is set, nothing is saved when
+        checkpoint_interval seconds have not passed since the previous
+        checkpoint. Returns True when a checkpoint was saved.
+        """
+        if self.checkpoint_file is None:
+            raise RuntimeError("checkpoint() requires CDMMetrics(checkpoint_file=...)")
+        now = time.monotonic()
+        if (not force and self.checkpoint_interval is not None and self._last_checkpoint is not None
+                and now - self._last_checkpoint < self.checkpoint_interval):
+            return False
+        files = []
+        for mf in self.files.values():
+            files.append({
+                "file_id": mf.file_id,
+                "blocks": [list(block) for block in mf.fh.sync()],
+                "index": None if mf.index is None else {str(idx): entries for idx, entries in mf.index.items()},
+                "deadbands": {str(idx): list(deadband) for idx, deadband in mf.deadbands.items()},
+                "descs": mf.descs,
+                "name_keys": mf.name_keys,
+                "name_values": mf.name_values,
+                "begins": mf.begins,
+                "ends": mf.ends,
+                "values": mf.values,
+                "intervals": mf.intervals,
+                "num_written": mf.num_written.tolist(),
+            })
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "progress": progress,
+            "file_id": self.file_id,
+            "total_logged_samples": self.total_logged_samples,
+            "total_cons_samples": self.total_cons_samples,
+            "files": files,
+        }
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_file, self.checkpoint_file)
+        self._last_checkpoint = now
+        return True
+
+    def resume(self):
+        """Restore the state saved by checkpoint() and return its progress value.
+
+        Must be called on a new instance, before anything is logged.
+        Returns None when there is no checkpoint_file (a fresh start).
+        Files finished before the checkpoint are already complete and
+        are left alone.
+        """
+        if self.checkpoint_file is None:
+            raise RuntimeError("resume() requires CDMMetrics(checkpoint_file=...)")
+        if self.files:
+            raise RuntimeError("resume() must be called before any sample is logged")
+        try:
+            with open(self.checkpoint_file) as fh:
+                state = json.load(fh)
+        except FileNotFoundError:
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"{self.checkpoint_file} is not a version {CHECKPOINT_VERSION} checkpoint")
+        for saved in state["files"]:
+            metric_data_file = os.path.join(self.output_dir, "metric-data-" + saved["file_id"] + ".csv.xz")
+            fh = XZBlockWriter(metric_data_file, self.level, self.block_size, saved["blocks"])
+            mf = _MetricFile(saved["file_id"], fh)
+            if self.index:
+                mf.index = {int(idx): entries for idx, entries in (saved["index"] or {}).items()}
+            for desc, keys, values in zip(saved["descs"], saved["name_keys"], saved["name_values"]):
+                names = dict(zip(keys, values))
+                _, key, keys, values = self._lookup_metric(mf, desc, names)
+                self._register(mf, key, keys, values, desc, None)
+            mf.begins = saved["begins"]
+            mf.ends = saved["ends"]
+            mf.values = saved["values"]
+            mf.intervals = saved["intervals"]
+            mf.num_written = array("Q", saved["num_written"])
+            mf.deadbands = {int(idx): Deadband(*deadband) for idx, deadband in saved["deadbands"].items()}
+            self.files[mf.file_id] = mf
+        if state["file_id"] in self.files:
+            self._select_file(state["file_id"])
+        self.total_logged_samples = state["total_logged_samples"]
+        self.total_cons_samples = state["total_cons_samples"]
+        self._last_checkpoint = time.monotonic()
+        return state["progress"]
+
+    def remove_checkpoint(self):
+        """Delete checkpoint_file, e.g. once every file has been finished."""
+        if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def _release_file(self, file_id):
+        mf = self.files.pop(file_id)
+        if mf is self._current:
+            self._current = None
+            self.file_id = None
+        return mf
+
+    def finish_samples(self, dont_delete=False, file_id=None):
+        """Write the remaining samples and the JSON descriptor of one file.
+
+        Finishes file_id, or the current file (the one most recently
+        passed to log_sample()) when file_id is None. Metrics that only
+        ever had a single sample of value 0 are dropped unless
+        dont_delete is set. Returns the metric-data file prefix, or None
+        if there is nothing to finish.
+        """
+        if file_id is None:
+            file_id = self.file_id
+        if file_id is None or file_id not in self.files:
+            return None
+        return self._finish_file(self._release_file(file_id), dont_delete)
+
+    def finish_all_samples(self, dont_delete=False, max_workers=None):
+        """Finish every open file, compressing them in parallel.
+
+        See finish_samples_parallel(). Returns the list of metric-data
+        file prefixes in file_id order of first use.
+        """
+        return [prefix for prefix, _ in finish_samples_parallel([self], dont_delete, max_workers)]
+
+
+def finish_samples_parallel(metrics, dont_delete=False, max_workers=None):
+    """Finish every open file of a collection of CDMMetrics instances.
+
+    The files are finished concurrently with
+    toolbox.parallel.run_parallel_jobs(). That is a thread pool rather
+    than a process pool: the open compressed streams cannot be handed to
+    another process. liblzma (and zlib/bz2) release the GIL while they
+    compress, so the trailing compression of each file still runs on its
+    own core.
+
+    Returns a list of (prefix, seconds) tuples, one per finished file,
+    in instance order and then file_id order of first use. seconds is
+    the wall time spent finishing that file. The first error raised by
+    any file is re-raised after all of them have been attempted.
+    """
+    jobs = []
+    for cdm in metrics:
+        for file_id in list(cdm.files):
+            jobs.append((cdm, cdm._release_file(file_id)))
+    if not jobs:
+        return []
+
+    def finish(job):
+        cdm, mf = job
+        start = time.perf_counter()
+        prefix = cdm._finish_file(mf, dont_delete)
+        return prefix, time.perf_counter() - start
+
+    results = dict(run_parallel_jobs(jobs, finish, max_workers))
+    timings = []
+    for job in jobs:
+        if isinstance(results[job], Exception):
+            raise results[job]
+        timings.append(results[job])
+    return timings
+
+
+class _TimedWriter:
+    """Metric-data stream proxy that times the writes of an InstrumentedCDMMetrics."""
+
+    def __init__(self, fh, cdm):
+        self.fh = fh
+        self.cdm = cdm
+
+    def write(self, data):
+        counts = self.cdm._writing
+        if counts is not None:
+            counts[2] += len(data)
+        self.cdm._bytes_in += len(data)
+        return self.cdm._timed("compression", self.fh.write, data)
+
+    def write_sample(self, idx, begin, end, value):
+        counts = self.cdm._writing
+        if counts is not None:
+            counts[2] += RECORD_SIZE
+        self.cdm._bytes_in += RECORD_SIZE
+        self.cdm._timed("compression", self.fh.write_sample, idx, begin, end, value)
+
+    def close(self):
+        self.cdm._timed("compression", self.fh.close)
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+
+class InstrumentedCDMMetrics(CDMMetrics):
+    """CDMMetrics that measures where its time goes.
+
+    Takes the same arguments as CDMMetrics, plus log_at_finish to log a
+    summary (at INFO level) every time a file is finished. The
+    instrumentation costs a few timer calls per sample, which is why it
+    is a separate class rather than an option of CDMMetrics.
+    get_instrumentation() returns a dict with:
+
+    seconds: wall time spent in metric lookup (label/key building),
+        consolidation (the per-sample bookkeeping, including metric
+        registration), formatting (building the metric-data rows),
+        compression (in the compressed stream's write() and close(),
+        minus the time of the file writes underneath), file_io (writing
+        compressed bytes to disk, for every file written) and finish
+        (finish_samples() work not counted elsewhere: the descriptor and
+        sidecar JSON). Each section's time excludes that of the sections
+        it calls. With background_writer, compression is only the time
+        spent handing data to the writer thread, and files finished in
+        parallel (finish_all_samples()) overlap each other.
+    bytes_in/bytes_out: metric-data text (or binary records, at
+        cdm_binary.RECORD_SIZE bytes each) handed to the compressed
+        streams, and bytes written to disk.
+    logged_samples, written_samples, consolidation_ratio: totals, and
+        types: the same plus bytes_in per "source:type" of the metrics.
+    """
+
+    _SECTIONS = ("lookup", "consolidation", "formatting", "compression", "finish")
+
+    def __init__(self, *args, log_at_finish=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log_at_finish = log_at_finish
+        self._io_counter = IOCounter()
+        self._seconds = dict.fromkeys(self._SECTIONS, 0.0)
+        self._bytes_in = 0
+        # "source:type" -> [logged, written, bytes_in]
+        self._types = {}
+        self._writing = None
+
+    def _accounted(self):
+        return sum(self._seconds.values()) + self._io_counter.seconds
+
+    def _timed(self, section, fn, *args):
+        """Call fn, adding its time minus that of nested sections to section."""
+        before = self._accounted()
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._seconds[section] += elapsed - (self._accounted() - before)
+
+    def _type_counts(self, mf, idx):
+        desc = mf.descs[idx]
+        key = str(desc["source"]) + ":" + str(desc["type"])
+        counts = self._types.get(key)
+        if counts is None:
+            counts = self._types[key] = [0, 0, 0]
+        return counts
+
+    def _select_file(self, file_id):
+        new = file_id not in self.files
+        mf = super()._select_file(file_id)
+        if new:
+            mf.fh = _TimedWriter(mf.fh, self)
+        return mf
+
+    def _lookup_metric(self, mf, desc, names):
+        return self._timed("lookup", super()._lookup_metric, mf, desc, names)
+
+    def _register(self, mf, key, keys, values, desc, sample):
+        idx = super()._register(mf, key, keys, values, desc, sample)
+        if sample is not None:
+            self._type_counts(mf, idx)[0] += 1
+        return idx
+
+    def log_sample(self, file_id, desc, names, sample):
+        return self._timed("consolidation", super().log_sample, file_id, desc, names, sample)
+
+    def log_sample_by_idx(self, idx, value, end, begin=None, file_id=None):
+        self._timed("consolidation", super().log_sample_by_idx, idx, value, end, begin, file_id)
+        mf = self._current if file_id is None else self.files[file_id]
+        self._type_counts(mf, idx)[0] += 1
+
+    def log_samples(self, file_id, desc, names, ends, values, begins=None):
+        logged = sum(counts[0] for counts in self._types.values())
+        idx = self._timed("consolidation", super().log_samples, file_id, desc, names, ends, values, begins)
+        if idx is not None:
+            # samples consolidated in bulk did not go through log_sample_by_idx()
+            counts = self._type_counts(self._current, idx)
+            counts[0] += len(values) - (sum(counts[0] for counts in self._types.values()) - logged)
+        return idx
+
+    def _write_sample(self, mf, idx, begin, end, value):
+        counts = self._writing = self._type_counts(mf, idx)
+        counts[1] += 1
+        try:
+            self._timed("formatting", super()._write_sample, mf, idx, begin, end, value)
+        finally:
+            self._writing = None
+
+    def _write_rows(self, mf, idx, rows):
+        counts = self._writing = self._type_counts(mf, idx)
+        counts[1] += len(rows)
+        try:
+            self._timed("formatting", super()._write_rows, mf, idx, rows)
+        finally:
+            self._writing = None
+
+    def _finish_file(self, mf, dont_delete):
+        prefix = self._timed("finish", super()._finish_file, mf, dont_delete)
+        if self.log_at_finish:
+            logger.info("CDMMetrics instrumentation after finishing %s:\n%s",
+                        prefix, self.format_instrumentation())
         return prefix
+
+    def get_instrumentation(self):
+        """Return the measurements so far as a dict (see the class docstring)."""
+        seconds = dict(self._seconds)
+        seconds["file_io"] = self._io_counter.seconds
+        types = {}
+        for key, (logged, written, bytes_in) in sorted(self._types.items()):
+            types[key] = {
+                "logged_samples": logged,
+                "written_samples": written,
+                "consolidation_ratio": logged / written if written else None,
+                "bytes_in": bytes_in,
+            }
+        logged = sum(counts["logged_samples"] for counts in types.values())
+        written = sum(counts["written_samples"] for counts in types.values())
+        return {
+            "seconds": seconds,
+            "bytes_in": self._bytes_in,
+            "bytes_out": self._io_counter.bytes_written,
+            "logged_samples": logged,
+            "written_samples": written,
+            "consolidation_ratio": logged / written if written else None,
+            "types": types,
+        }
+
+    def format_instrumentation(self):
+        """Return get_instrumentation() as human readable lines."""
+        stats = self.get_instrumentation()
+        lines = ["  " + ", ".join("%s %.3fs" % item for item in stats["seconds"].items())]
+        lines.append("  bytes in %d, out %d; samples logged %d, written %d" % (
+            stats["bytes_in"], stats["bytes_out"], stats["logged_samples"], stats["written_samples"]))
+        for key, counts in stats["types"].items():
+            ratio = counts["consolidation_ratio"]
+            lines.append("  %s: logged %d, written %d, ratio %s, bytes in %d" % (
+                key, counts["logged_samples"], counts["written_samples"],
+                "-" if ratio is None else "%.2f" % ratio, counts["bytes_in"]))
+        return "\n".join(lines)
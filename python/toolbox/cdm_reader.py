@@ -0,0 +1,185 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import os
+from collections import namedtuple
+
+from toolbox.cdm_binary import iter_binary_samples
+from toolbox.fileio import open_read_text_file
+from toolbox.json import json_loads
+from toolbox.xz import XZBlock, read_block
+
+
+MetricSample = namedtuple("MetricSample", ["idx", "begin", "end", "value"])
+RollupSample = namedtuple("RollupSample", ["idx", "begin", "end", "avg", "min", "max"])
+
+
+def _parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class MetricDataReader:
+    """Streaming reader for a metric-data-<id>.csv/.json pair.
+
+    path_prefix is the metric-data file path without its extensions,
+    e.g. os.path.join(output_dir, cdm.finish_samples()). The compression
+    codec of both files is detected automatically, and a binary
+    metric-data-<id>.bin file (see toolbox.cdm_binary) is read in place
+    of the csv when it exists. The JSON descriptor is loaded up front
+    (metric_types maps idx to its desc and names); the samples are only
+    read when iterated, chunk_size characters of lines (or one binary
+    or indexed xz block) at a time, so memory use does not depend on the
+    file size.
+    """
+
+    def __init__(self, path_prefix, chunk_size=1 << 20):
+        self.path_prefix = path_prefix
+        self.chunk_size = chunk_size
+        fh, self.json_file = open_read_text_file(path_prefix + ".json")
+        with fh:
+            self.metric_types = {metric["idx"]: metric for metric in json_loads(fh.read())}
+        self._index = False
+
+    def select(self, idx=None, source=None, type=None, names=None):
+        """Return the set of metric idx matching every given filter.
+
+        idx is a single idx or an iterable of them, source and type match
+        the metric desc, and names matches metrics whose names include
+        all of the given name/value pairs.
+        """
+        if idx is None:
+            selected = set(self.metric_types)
+        elif isinstance(idx, int):
+            selected = {idx} & self.metric_types.keys()
+        else:
+            selected = set(idx) & self.metric_types.keys()
+        for i in list(selected):
+            metric = self.metric_types[i]
+            if source is not None and metric["desc"]["source"] != source:
+                selected.discard(i)
+            elif type is not None and metric["desc"]["type"] != type:
+                selected.discard(i)
+            elif names is not None and any(
+                metric["names"].get(name) != value for name, value in names.items()
+            ):
+                selected.discard(i)
+        return selected
+
+    def load_index(self):
+        """Load the metric-data-<id>.index.json sidecar, or return None."""
+        if self._index is False:
+            try:
+                fh, _ = open_read_text_file(self.path_prefix + ".index.json")
+            except FileNotFoundError:
+                self._index = None
+            else:
+                with fh:
+                    index = json_loads(fh.read())
+                self._index = {
+                    "blocks": [XZBlock(*block) for block in index["blocks"]],
+                    "metrics": {int(idx): entries for idx, entries in index["metrics"].items()},
+                }
+        return self._index
+
+    def _index_blocks(self, wanted, begin, end):
+        """Return the sorted block numbers holding samples of wanted within begin..end."""
+        index = self.load_index()
+        blocks = set()
+        for idx in (index["metrics"] if wanted is None else wanted):
+            for block, first_begin, last_end in index["metrics"].get(idx, []):
+                if (begin is None or last_end >= begin) and (end is None or first_begin <= end):
+                    blocks.add(block)
+        return sorted(blocks)
+
+    def _parse_lines(self, lines, wanted, begin, end):
+        for line in lines:
+            fields = line.split(",")
+            metric_idx = int(fields[0])
+            if wanted is not None and metric_idx not in wanted:
+                continue
+            sample = MetricSample(
+                metric_idx,
+                _parse_number(fields[1]),
+                _parse_number(fields[2]),
+                _parse_number(fields[3]),
+            )
+            if (begin is None or sample.end >= begin) and (end is None or sample.begin <= end):
+                yield sample
+
+    def samples(self, idx=None, source=None, type=None, names=None, begin=None, end=None):
+        """Lazily yield MetricSample(idx, begin, end, value) tuples.
+
+        Samples are yielded in file order (for each metric that is time
+        order). With any filter given only samples of the metrics picked
+        by select() are yielded, and begin/end restrict them to samples
+        overlapping that time range. When an index sidecar exists only
+        the xz blocks that can hold matching samples are decompressed.
+        Values from a csv file are returned as int when they were written
+        as integers and as float otherwise; values from a binary file are
+        always float.
+        """
+        wanted = None
+        if idx is not None or source is not None or type is not None or names is not None:
+            wanted = self.select(idx, source, type, names)
+            if not wanted:
+                return
+        if os.path.exists(self.path_prefix + ".bin"):
+            for sample in iter_binary_samples(self.path_prefix + ".bin"):
+                if ((wanted is None or sample[0] in wanted)
+                        and (begin is None or sample[2] >= begin) and (end is None or sample[1] <= end)):
+                    yield MetricSample._make(sample)
+            return
+        if (wanted is not None or begin is not None or end is not None) and self.load_index() is not None:
+            blocks = self._index["blocks"]
+            with open(self.path_prefix + ".csv.xz", "rb") as fh:
+                for block in self._index_blocks(wanted, begin, end):
+                    lines = read_block(fh, blocks[block]).decode().splitlines()
+                    yield from self._parse_lines(lines, wanted, begin, end)
+            return
+        fh, _ = open_read_text_file(self.path_prefix + ".csv")
+        with fh:
+            while True:
+                lines = fh.readlines(self.chunk_size)
+                if not lines:
+                    break
+                yield from self._parse_lines(lines, wanted, begin, end)
+
+    def rollup_samples(self, interval, idx=None, source=None, type=None, names=None, begin=None, end=None):
+        """Lazily yield RollupSample(idx, begin, end, avg, min, max) tuples.
+
+        Reads the metric-data-<id>.rollup-<interval>.csv companion file
+        written by CDMMetrics(rollups=[interval, ...]); the filters are
+        the same as for samples(). avg is always a float.
+        """
+        wanted = None
+        if idx is not None or source is not None or type is not None or names is not None:
+            wanted = self.select(idx, source, type, names)
+            if not wanted:
+                return
+        fh, _ = open_read_text_file(self.path_prefix + ".rollup-" + str(interval) + ".csv")
+        with fh:
+            while True:
+                lines = fh.readlines(self.chunk_size)
+                if not lines:
+                    break
+                for line in lines:
+                    fields = line.split(",")
+                    metric_idx = int(fields[0])
+                    if wanted is not None and metric_idx not in wanted:
+                        continue
+                    sample = RollupSample(
+                        metric_idx,
+                        int(fields[1]),
+                        int(fields[2]),
+                        float(fields[3]),
+                        _parse_number(fields[4]),
+                        _parse_number(fields[5]),
+                    )
+                    if (begin is None or sample.end >= begin) and (end is None or sample.begin <= end):
+                        yield sample
+
+    def __iter__(self):
+        return self.samples()
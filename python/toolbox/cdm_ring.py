@@ -0,0 +1,326 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+"""Shared-memory sample rings feeding one CDMMetrics from many processes.
+
+A RingConsumer owns a CDMMetrics and one single-producer/single-consumer
+ring buffer in multiprocessing.shared_memory per producer. Worker
+processes get a RingProducer (it can be passed to a
+multiprocessing.Process) and log samples with the same calls as
+CDMMetrics; the samples travel through the ring as fixed 32 byte records
+and the consumer feeds them to log_sample_by_idx(), so there is one
+consolidated metric-data file and one compression stream per file_id.
+
+Metric registrations (desc and names) are sent once per metric over a
+multiprocessing.Queue shared by all producers; records only carry the
+producer's id for the metric. A record is:
+
+    uint32 metric id, uint32 flags, int64 end, int64 begin, value
+
+where value is an int64 or a float64 depending on the flags, in host
+byte order (producers and the consumer run on the same host). Sample
+values must therefore be floats or integers that fit in an int64; other
+values (including bool, which would arrive as 1/0) are rejected by
+log_sample_by_idx() with TypeError or ValueError. Each metric must be
+logged by a single producer, since only the order within one ring is
+preserved.
+"""
+
+import multiprocessing
+import operator
+import queue
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+RECORD_SIZE = 32
+DEFAULT_CAPACITY = 1 << 16
+
+_FLAG_FLOAT = 0x1
+_FLAG_BEGIN = 0x2
+_INT_RECORD = struct.Struct("=IIqqq")
+_FLOAT_RECORD = struct.Struct("=IIqqd")
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+# Header words (uint64): head (records written), tail (records read),
+# capacity and closed flag, each on its own cache line. They are accessed
+# through a native "Q" memoryview so every update is a single aligned
+# 8 byte store that the other process can never see half written.
+_HEAD = 0
+_TAIL = 8
+_CAPACITY = 16
+_CLOSED = 24
+_HEADER_SIZE = 256
+
+
+class _Ring:
+    """One SPSC ring of RECORD_SIZE records in a SharedMemory segment."""
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_HEADER_SIZE + capacity * RECORD_SIZE)
+            self.shm.buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.header = self.shm.buf[:_HEADER_SIZE].cast("Q")
+        if name is None:
+            self.header[_CAPACITY] = capacity
+        self.capacity = self.header[_CAPACITY]
+
+    def _get(self, word):
+        return self.header[word]
+
+    def _set(self, word, value):
+        self.header[word] = value
+
+    def put(self, records, wait=0.0001):
+        """Copy whole records into the ring, waiting for the consumer when it is full."""
+        view = memoryview(records)
+        capacity = self.capacity
+        head = self._get(_HEAD)
+        num = len(records) // RECORD_SIZE
+        done = 0
+        while done < num:
+            free = capacity - (head - self._get(_TAIL))
+            if free == 0:
+                time.sleep(wait)
+                continue
+            slot = head % capacity
+            count = min(num - done, free, capacity - slot)
+            start = _HEADER_SIZE + slot * RECORD_SIZE
+            self.shm.buf[start:start + count * RECORD_SIZE] = view[done * RECORD_SIZE:(done + count) * RECORD_SIZE]
+            done += count
+            head += count
+            # publish the records only once they are completely written
+            self._set(_HEAD, head)
+
+    def take(self):
+        """Return a copy of all pending records and mark them consumed."""
+        head = self._get(_HEAD)
+        tail = self._get(_TAIL)
+        if head == tail:
+            return b""
+        capacity = self.capacity
+        chunks = []
+        position = tail
+        while position < head:
+            slot = position % capacity
+            count = min(head - position, capacity - slot)
+            start = _HEADER_SIZE + slot * RECORD_SIZE
+            chunks.append(bytes(self.shm.buf[start:start + count * RECORD_SIZE]))
+            position += count
+        self._set(_TAIL, head)
+        return b"".join(chunks)
+
+    @property
+    def closed(self):
+        return self._get(_CLOSED) != 0
+
+    def mark_closed(self):
+        self._set(_CLOSED, 1)
+
+    def close(self):
+        self.header.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class RingProducer:
+    """Producer side of a ring, for use in one worker process.
+
+    The methods mirror CDMMetrics: register_metric() and log_sample()
+    return a metric id that log_sample_by_idx() accepts. Records are
+    batched locally and copied into the ring batch_size at a time (and
+    on flush() and close()). close() must be called when the producer
+    is done, it is how the consumer knows the ring is finished.
+    """
+
+    def __init__(self, ring_name, registrations, producer_id, batch_size=256):
+        self.ring_name = ring_name
+        self.registrations = registrations
+        self.producer_id = producer_id
+        self.batch_size = batch_size
+        self._ring = None
+        self._ids = {}
+        self._buffer = bytearray()
+        self._pending = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_ring"] = None
+        return state
+
+    def _get_ring(self):
+        if self._ring is None:
+            self._ring = _Ring(self.ring_name)
+        return self._ring
+
+    def register_metric(self, file_id, desc, names):
+        """Return the id of a metric, announcing it to the consumer on first use."""
+        try:
+            key = (file_id, desc["source"], desc["type"], tuple(sorted(names.items())))
+            metric_id = self._ids.get(key)
+        except TypeError:
+            key = (file_id, desc["source"], desc["type"], repr(sorted(names.items())))
+            metric_id = self._ids.get(key)
+        if metric_id is None:
+            metric_id = len(self._ids)
+            self._ids[key] = metric_id
+            self.registrations.put((self.producer_id, metric_id, file_id, desc, names))
+        return metric_id
+
+    def log_sample(self, file_id, desc, names, sample):
+        """Queue a sample dict ({"end", "value"[, "begin"]}); returns the metric id."""
+        metric_id = self.register_metric(file_id, desc, names)
+        self.log_sample_by_idx(metric_id, sample["value"], sample["end"], sample.get("begin"))
+        return metric_id
+
+    def log_sample_by_idx(self, idx, value, end, begin=None):
+        """Queue a sample of a metric id returned by register_metric()/log_sample().
+
+        Raises TypeError if value is not a float or an integer (bool
+        included) and ValueError if an integer does not fit in an int64.
+        """
+        flags = 0 if begin is None else _FLAG_BEGIN
+        if isinstance(value, float):
+            self._buffer += _FLOAT_RECORD.pack(idx, flags | _FLAG_FLOAT, end, begin or 0, value)
+        else:
+            if isinstance(value, bool):
+                raise TypeError(f"Sample value of metric {idx} is a bool, expected an int or a float")
+            try:
+                value = operator.index(value)
+            except TypeError:
+                raise TypeError(f"Sample value of metric {idx} must be an int or a float, "
+                                f"not {type(value).__name__}") from None
+            if not _INT64_MIN <= value <= _INT64_MAX:
+                raise ValueError(f"Sample value {value} of metric {idx} does not fit in an int64")
+            self._buffer += _INT_RECORD.pack(idx, flags, end, begin or 0, value)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._get_ring().put(self._buffer)
+            self._buffer = bytearray()
+            self._pending = 0
+
+    def close(self):
+        """Flush the pending records and tell the consumer this ring is finished."""
+        self.flush()
+        ring = self._get_ring()
+        ring.mark_closed()
+        ring.close()
+        self._ring = None
+
+
+class RingConsumer:
+    """Consumer side: drains every producer ring into one CDMMetrics.
+
+    Create it in the writer process, hand new_producer() results to the
+    worker processes, then call run(), which returns once every producer
+    has closed its ring and all records have been logged. The
+    CDMMetrics is left open; finish it as usual (e.g. with
+    finish_all_samples()). close() releases the shared memory.
+    """
+
+    def __init__(self, cdm, capacity=DEFAULT_CAPACITY, context=None):
+        self.cdm = cdm
+        self.capacity = capacity
+        context = context if context is not None else multiprocessing.get_context()
+        self.registrations = context.Queue()
+        self._rings = []
+        # per producer: metric id -> (file_id, CDMMetrics idx)
+        self._metrics = []
+
+    def new_producer(self, batch_size=256):
+        """Create a ring and return the RingProducer for it."""
+        ring = _Ring(capacity=self.capacity)
+        producer_id = len(self._rings)
+        self._rings.append(ring)
+        self._metrics.append({})
+        return RingProducer(ring.name, self.registrations, producer_id, batch_size)
+
+    def _register(self, wait):
+        """Register queued metrics; with wait, block until at least one arrives."""
+        while True:
+            try:
+                producer_id, metric_id, file_id, desc, names = self.registrations.get(block=wait, timeout=1)
+            except queue.Empty:
+                return False
+            idx = self.cdm.register_metric(desc, names, file_id)
+            self._metrics[producer_id][metric_id] = (file_id, idx)
+            wait = False
+
+    def _lookup(self, producer_id, metric_id):
+        metrics = self._metrics[producer_id]
+        while metric_id not in metrics:
+            # the registration is queued before the records that use it
+            if not self._register(True) and metric_id not in metrics:
+                raise RuntimeError(f"No registration received for metric {metric_id} of producer {producer_id}")
+        return metrics[metric_id]
+
+    def poll(self):
+        """Log all records pending in every ring; returns how many were logged."""
+        total = 0
+        log_sample_by_idx = self.cdm.log_sample_by_idx
+        for producer_id, ring in enumerate(self._rings):
+            records = ring.take()
+            if not records:
+                continue
+            metrics = self._metrics[producer_id]
+            words = memoryview(records).cast("I")
+            ints = memoryview(records).cast("q")
+            floats = memoryview(records).cast("d")
+            num = len(records) // RECORD_SIZE
+            for r in range(num):
+                metric_id = words[8 * r]
+                flags = words[8 * r + 1]
+                target = metrics.get(metric_id)
+                if target is None:
+                    target = self._lookup(producer_id, metric_id)
+                file_id, idx = target
+                value = floats[4 * r + 3] if flags & _FLAG_FLOAT else ints[4 * r + 3]
+                begin = ints[4 * r + 2] if flags & _FLAG_BEGIN else None
+                log_sample_by_idx(idx, value, ints[4 * r + 1], begin, file_id)
+            total += num
+        return total
+
+    def run(self, wait=0.0005, processes=None):
+        """Consume until every producer has closed its ring and it is drained.
+
+        processes optionally lists the producer processes in
+        new_producer() order. A producer whose process exits without
+        closing its ring then raises RuntimeError (once everything it did
+        write has been logged) instead of blocking forever.
+        """
+        while True:
+            # read the closed flags before draining, so nothing written
+            # before a producer closed can be missed
+            done = [ring.closed or (processes is not None and not processes[i].is_alive())
+                    for i, ring in enumerate(self._rings)]
+            if self.poll() == 0:
+                if all(done):
+                    break
+                self._register(False)
+                time.sleep(wait)
+        for i, ring in enumerate(self._rings):
+            if not ring.closed:
+                raise RuntimeError(f"Producer {i} exited without closing its ring")
+
+    def close(self):
+        for ring in self._rings:
+            ring.close()
+            ring.unlink()
+        self._rings = []
+        self.registrations.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,29 +1,407 @@
+import bz2
+import gzip
+import io
 import lzma
+import mmap
 import os
+import queue
+import threading
+import time
 
+from toolbox.xz import DEFAULT_BLOCK_SIZE, XZBlockReader, XZBlockWriter
 
-def open_write_text_file(filename):
-    """Open a file for writing with automatic xz compression.
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
-    If the filename doesn't already end in '.xz', '.xz' is appended.
+
+# codec name -> filename extension, in the order open_read_text_file()
+# probes for compressed variants of a filename
+COMPRESSION_EXTENSIONS = {
+    "xz": ".xz",
+    "gzip": ".gz",
+    "bz2": ".bz2",
+    "zstd": ".zst",
+    "none": "",
+}
+
+_MAGIC_BYTES = {
+    "xz": b"\xfd7zXZ\x00",
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+
+def _detect_codec(filename):
+    """Return the codec of an existing file based on its magic bytes."""
+    with open(filename, "rb") as fh:
+        head = fh.read(6)
+    for codec, magic in _MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return codec
+    return "none"
+
+
+class IOCounter:
+    """Bytes written to disk, and the seconds spent writing them, by the
+    files opened with open_write_text_file(..., io_counter=...)."""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.seconds = 0.0
+
+
+class _CountedFile(io.RawIOBase):
+    """Raw binary file that adds its writes to an IOCounter."""
+
+    def __init__(self, fh, counter):
+        self.fh = fh
+        self.counter = counter
+
+    @property
+    def name(self):
+        return self.fh.name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        start = time.perf_counter()
+        written = self.fh.write(data)
+        self.counter.seconds += time.perf_counter() - start
+        self.counter.bytes_written += written
+        return written
+
+    def flush(self):
+        if not self.fh.closed:
+            start = time.perf_counter()
+            self.fh.flush()
+            self.counter.seconds += time.perf_counter() - start
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def tell(self):
+        return self.fh.tell()
+
+    def seek(self, offset, whence=0):
+        return self.fh.seek(offset, whence)
+
+    def truncate(self, size=None):
+        return self.fh.truncate(size)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+                start = time.perf_counter()
+                self.fh.close()
+                self.counter.seconds += time.perf_counter() - start
+            finally:
+                super().close()
+
+
+class _CountedTextFile(io.TextIOWrapper):
+    """Text file over a codec stream on a _CountedFile; closes both."""
+
+    def __init__(self, buffer, raw):
+        super().__init__(buffer)
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            # codec streams opened on a file object leave it open
+            self._raw.close()
+
+
+def _open_codec(filename, mode, codec, level=None):
+    if codec == "xz":
+        return lzma.open(filename, mode, preset=level)
+    if codec == "gzip":
+        return gzip.open(filename, mode, compresslevel=9 if level is None else level)
+    if codec == "bz2":
+        return bz2.open(filename, mode, compresslevel=9 if level is None else level)
+    if codec == "zstd":
+        if zstd is None:
+            raise ValueError("zstd codec requested but neither compression.zstd nor zstandard is available")
+        if zstd.__name__ == "zstandard":
+            cctx = zstd.ZstdCompressor(level=3 if level is None else level) if "w" in mode else None
+            return zstd.open(filename, mode, cctx=cctx)
+        return zstd.open(filename, mode, level=level)
+    return open(filename, mode)
+
+
+def _check_codec(codec):
+    if codec not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unknown compression codec '{codec}', expected one of: "
+                         + ", ".join(COMPRESSION_EXTENSIONS))
+
+
+def open_write_text_file(filename, codec="xz", level=None, block_size=None, io_counter=None, threads=None):
+    """Open a file for writing with automatic compression.
+
+    codec is one of COMPRESSION_EXTENSIONS ("xz" by default, "gzip",
+    "bz2", "zstd" when a zstd module is importable, or "none") and level
+    is the codec's compression level/preset (e.g. xz presets 0-9), or
+    None for the codec default. If the filename doesn't already end in
+    the codec's extension it is appended.
+    With codec "xz", block_size makes the file a sequence of independently
+    decompressible blocks of about that many bytes (see
+    toolbox.xz.XZBlockWriter) instead of a single block. threads > 1 (0
+    for one per CPU) compresses that many blocks in parallel, splitting
+    large writes into several blocks, and implies blocks of
+    DEFAULT_BLOCK_SIZE bytes when block_size is not given; the file
+    still decompresses with plain "xz -d".
+    io_counter, an IOCounter, accumulates the bytes written to the file
+    on disk (after compression) and the time spent writing them.
     Returns the opened file handle (text mode) and the actual filename used.
     """
-    if not filename.endswith(".xz"):
-        filename += ".xz"
-    return lzma.open(filename, "wt"), filename
+    _check_codec(codec)
+    extension = COMPRESSION_EXTENSIONS[codec]
+    if not filename.endswith(extension):
+        filename += extension
+    if threads is not None and threads != 1 and block_size is None:
+        block_size = DEFAULT_BLOCK_SIZE
+    if block_size is not None:
+        if codec != "xz":
+            raise ValueError("block_size and threads are only supported with the xz codec")
+        fh = XZBlockWriter(filename, level, block_size, threads=threads)
+        if io_counter is not None:
+            io_counter.bytes_written += fh.fh.tell()
+            fh.fh = _CountedFile(fh.fh, io_counter)
+        return fh, filename
+    if io_counter is None:
+        return _open_codec(filename, "wt", codec, level), filename
+    raw = _CountedFile(open(filename, "wb", buffering=0), io_counter)
+    if codec == "none":
+        return _CountedTextFile(io.BufferedWriter(raw), raw), filename
+    return _CountedTextFile(_open_codec(raw, "wb", codec, level), raw), filename
 
 
-def open_read_text_file(filename):
-    """Open a file for reading with transparent xz decompression.
+def open_read_text_file(filename, threads=None):
+    """Open a file for reading with transparent decompression.
 
-    If filename.xz exists, it is preferred over the uncompressed version.
+    If a compressed variant (filename.xz, .gz, .bz2 or .zst) exists it is
+    preferred over the uncompressed version. The codec is detected from
+    the file's magic bytes, not trusted from its extension.
+    With threads given, an xz file is read through toolbox.xz.XZBlockReader:
+    threads > 1 (0 for one per CPU) decompresses its blocks in parallel,
+    and fh.seek() to any offset of the uncompressed data (e.g. the tail of
+    the file) only decompresses the block holding it. Other codecs ignore
+    threads. Large uncompressed files are read faster as bytes with a
+    MappedLineReader.
     Returns the opened file handle (text mode) and the actual filename used.
     """
-    xz_filename = filename + ".xz"
-    if os.path.exists(xz_filename):
-        return lzma.open(xz_filename, "rt"), xz_filename
-    if os.path.exists(filename):
-        if filename.endswith(".xz"):
-            return lzma.open(filename, "rt"), filename
-        return open(filename, "r"), filename
-    raise FileNotFoundError(f"Neither {filename} nor {xz_filename} found")
+    candidates = [filename + ext for ext in COMPRESSION_EXTENSIONS.values() if ext]
+    candidates.append(filename)
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            codec = _detect_codec(candidate)
+            if threads is not None and codec == "xz":
+                return io.TextIOWrapper(io.BufferedReader(XZBlockReader(candidate, threads))), candidate
+            return _open_codec(candidate, "rt", codec), candidate
+    raise FileNotFoundError(f"None of {', '.join(candidates)} found")
+
+
+class MappedLineReader:
+    """Line reader over an mmap of a large uncompressed file.
+
+    The file is split into line-aligned chunks of about chunk_size bytes
+    straight from the page cache, and each chunk is split into lines in
+    one call, instead of going through Python text I/O line by line.
+    Iterating yields each line without its b"\\n" as bytes, or as str
+    when an encoding is given. views() yields zero-copy memoryviews
+    instead. lines() and views() take a byte range, and ranges() splits
+    the file into line-aligned ranges, so that several workers can each
+    parse a part of the same file.
+    """
+
+    def __init__(self, filename, encoding=None, errors="strict", chunk_size=1 << 20):
+        self.filename = filename
+        self.encoding = encoding
+        self.errors = errors
+        self.chunk_size = chunk_size
+        with open(filename, "rb") as fh:
+            self.size = os.fstat(fh.fileno()).st_size
+            # an empty file cannot be mapped
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        if self._map is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def _line_start(self, offset):
+        """Return the offset of the first line beginning at or after offset."""
+        if offset <= 0:
+            return 0
+        if offset >= self.size:
+            return self.size
+        newline = self._map.find(b"\n", offset - 1)
+        return self.size if newline < 0 else newline + 1
+
+    def ranges(self, parts):
+        """Split the file into at most parts (start, end) ranges of whole lines."""
+        bounds = [self._line_start(self.size * part // parts) for part in range(parts)]
+        bounds.append(self.size)
+        return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+    def _chunks(self, start, end):
+        """Yield line-aligned (start, stop) spans covering the lines beginning in start..end."""
+        if self._map is None:
+            return
+        position = self._line_start(start)
+        end = self.size if end is None else min(end, self.size)
+        while position < end:
+            # the last line beginning before end runs up to its newline
+            stop = self._line_start(min(position + self.chunk_size, end))
+            yield position, stop
+            position = stop
+
+    def lines(self, start=0, end=None):
+        """Yield the lines beginning in start..end (byte offsets) as bytes."""
+        mapped = self._map
+        for position, stop in self._chunks(start, end):
+            lines = mapped[position:stop].split(b"\n")
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+
+    def views(self, start=0, end=None):
+        """Like lines(), but yield memoryviews into the mapping.
+
+        No data is copied, which pays off for long lines. Each view is
+        released when the next one is requested, so convert what has to
+        be kept (bytes(view)).
+        """
+        if self._map is None:
+            return
+        find = self._map.find
+        with memoryview(self._map) as mapped:
+            for position, stop in self._chunks(start, end):
+                while position < stop:
+                    newline = find(b"\n", position, stop)
+                    line_end = stop if newline < 0 else newline
+                    view = mapped[position:line_end]
+                    try:
+                        yield view
+                    finally:
+                        # the views must not outlive the mapping
+                        view.release()
+                    position = line_end + 1
+
+    def _decoded_lines(self):
+        mapped = self._map
+        for position, stop in self._chunks(0, None):
+            # chunks end on a newline, so never inside a character
+            lines = mapped[position:stop].decode(self.encoding, self.errors).split("\n")
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+
+    def __iter__(self):
+        if self.encoding is None:
+            return self.lines()
+        return self._decoded_lines()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BackgroundWriter:
+    """File-like wrapper that performs the wrapped handle's writes on a thread.
+
+    write() only appends to an in-memory buffer. Once buffer_size
+    characters are pending they are handed to a dedicated writer thread
+    through a queue bounded to max_pending chunks, so compression and
+    file I/O overlap with the caller, which only blocks when the writer
+    thread falls behind. close() flushes what is left, waits for the
+    thread and closes the wrapped handle. The first error raised by the
+    writer thread stops all further writes (the data from then on is
+    lost) and is re-raised from every later write(), flush() and close().
+    """
+
+    def __init__(self, fh, buffer_size=1 << 20, max_pending=8):
+        self.fh = fh
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self._error is None:
+                    self.fh.write(chunk)
+            except Exception as err:
+                # Keep draining the queue so the producer never blocks forever
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _submit(self):
+        if self._buffer:
+            self._queue.put("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    @property
+    def closed(self):
+        return self._thread is None
+
+    def write(self, text):
+        self._check_error()
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self._submit()
+        return len(text)
+
+    def flush(self):
+        self._check_error()
+        self._submit()
+        self._queue.join()
+        self._check_error()
+        self.fh.flush()
+
+    def close(self):
+        if self._thread is None:
+            self._check_error()
+            return
+        if self._error is None:
+            self._submit()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        try:
+            self._check_error()
+        finally:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,22 +1,170 @@
+import enum
 import json
 import lzma
+import math
+import re
+import uuid
 
 from jsonschema import validate
 from jsonschema import exceptions
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 from toolbox.fileio import open_write_text_file
 
 
+# leaves that orjson and the stdlib encode alike
+_PLAIN_TYPES = frozenset((str, int, bool, type(None)))
+
+
+def _needs_stdlib(obj):
+    """Return True if obj holds a value orjson encodes unlike the stdlib.
+
+    orjson writes NaN and Infinity as null and encodes UUID and Enum
+    values, which the stdlib keeps or rejects.
+    """
+    pending = [obj]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            items = value.values()
+        elif isinstance(value, (list, tuple)):
+            items = value
+        elif isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+            continue
+        elif isinstance(value, (uuid.UUID, enum.Enum)):
+            return True
+        else:
+            continue
+        # only look at the items that are not plain leaves
+        if not _PLAIN_TYPES.issuperset(map(type, items)):
+            pending.extend(item for item in items if type(item) not in _PLAIN_TYPES)
+    return False
+
+
+def _orjson_dumps(obj, indent, sort_keys):
+    if indent not in (None, 2):
+        return None
+    if _needs_stdlib(obj):
+        return None
+    # datetimes and dataclasses raise TypeError like in the stdlib
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    option |= (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    text = orjson.dumps(obj, option=option)
+    # the stdlib escapes non-ASCII characters and callers may rely on it
+    # (e.g. files opened with encoding="ascii")
+    if not text.isascii():
+        return None
+    return text.decode()
+
+
+def _ujson_dumps(obj, indent, sort_keys):
+    return ujson.dumps(obj, indent=indent or 0, sort_keys=sort_keys, ensure_ascii=True,
+                       escape_forward_slashes=False)
+
+
+# backend name -> (module, loads, dumps), in auto-detection order; a
+# missing dumps uses the stdlib
+_BACKENDS = {
+    "orjson": (orjson, orjson and orjson.loads, _orjson_dumps),
+    "ujson": (ujson, ujson and ujson.loads, _ujson_dumps),
+    "simdjson": (simdjson, simdjson and simdjson.loads, None),
+    "json": (json, json.loads, None),
+}
+JSON_BACKENDS = tuple(_BACKENDS)
+
+_backend = None
+_loads = json.loads
+_dumps = None
+
+
+def available_json_backends():
+    """Return the names of the importable JSON backends, in auto-detection order."""
+    return [name for name, (module, _, _) in _BACKENDS.items() if module is not None]
+
+
+def set_json_backend(name=None):
+    """Select the JSON backend used by the functions of this module.
+
+    name is one of JSON_BACKENDS, or None to pick the first importable
+    one (orjson, ujson, simdjson, then the stdlib json module). The fast
+    backends are used for what they handle like the stdlib; anything
+    else (a value they cannot encode, indents other than 2 for orjson,
+    non-ASCII output, text they refuse to decode) goes through the stdlib,
+    so results and error messages stay the same. Their output differs
+    only in formatting (no spaces after separators in compact output,
+    float exponents).
+    Raises ValueError for an unknown or missing backend.
+    """
+    global _backend, _loads, _dumps
+    if name is None:
+        name = available_json_backends()[0]
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown JSON backend '{name}', expected one of: " + ", ".join(JSON_BACKENDS))
+    module, loads, dumps = _BACKENDS[name]
+    if module is None:
+        raise ValueError(f"JSON backend '{name}' is not installed")
+    _backend = name
+    _loads = loads
+    _dumps = dumps
+
+
+def get_json_backend():
+    """Return the name of the selected JSON backend."""
+    return _backend
+
+
+def json_loads(data):
+    """Decode a JSON document (str or UTF-8 bytes) with the selected backend."""
+    if _loads is not json.loads:
+        try:
+            return _loads(data)
+        except (ValueError, TypeError, OverflowError):
+            # let the stdlib decide (NaN, huge integers, error message)
+            pass
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=None, sort_keys=False):
+    """Encode obj as JSON text with the selected backend (see set_json_backend())."""
+    if _dumps is not None:
+        try:
+            text = _dumps(obj, indent, sort_keys)
+        except (ValueError, TypeError, OverflowError):
+            text = None
+        if text is not None:
+            return text
+    return json.dumps(obj, indent=indent, sort_keys=sort_keys)
+
+
+set_json_backend()
+
+
 def load_json_file(json_file, uselzma = False):
     """Load JSON file and return a json object/error msg tuple"""
     err_msg = None
     try:
         if uselzma:
-            input_fp = lzma.open(json_file, 'rt')
+            input_fp = lzma.open(json_file, 'rb')
         else:
-            input_fp = open(json_file, 'r')
-        input_json = json.load(input_fp)
-        input_fp.close()
+            input_fp = open(json_file, 'rb')
+        with input_fp:
+            input_json = json_loads(input_fp.read())
         return input_json, None
     except FileNotFoundError as err:
         err_msg = f"Could not find JSON file { json_file }:{ err }"
@@ -31,9 +179,233 @@ def load_json_file(json_file, uselzma = False):
     return None, err_msg
 
 
-def save_json_file(filename, data, schema_file=None):
+_ALL_ITEMS = object()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# a complete string, an unterminated one (its opening quote) or a bracket
+_SKIP_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|[\[\]{}]', re.DOTALL)
+_NUMBER_CHARS = "0123456789.eE+-"
+# a decode error this close to the end of the buffer may be a value cut
+# by the end of the chunk ("-Infinity", a \\uXXXX escape)
+_CUT_VALUE_TAIL = 10
+
+
+def _parse_json_path(path):
+    """Split a path like "received[*]" or "a.b[*].c" into keys and _ALL_ITEMS."""
+    parts = []
+    for token in re.findall(r"\[\*\]|[^.\[]+|\.|.", path):
+        if token == "[*]":
+            parts.append(_ALL_ITEMS)
+        elif token == ".":
+            continue
+        elif token.startswith("["):
+            raise ValueError(f"Unsupported JSON path element '{token}' in '{path}', expected '[*]'")
+        else:
+            parts.append(token)
+    return parts
+
+
+class _JSONStream:
+    """Incremental JSON scanner over a text file handle.
+
+    Only the values selected by a path are decoded (each with
+    json.JSONDecoder.raw_decode()); everything else is skipped by
+    scanning for brackets and string ends, so memory use is bounded by
+    the size of the largest selected value, not of the document.
+    """
+
+    def __init__(self, fh, chunk_size=1 << 20):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        # position of buf[0] in the document, for error messages
+        self.consumed = 0
+        self.lineno = 1
+        self.colno = 1
+
+    def _fill(self, size=None):
+        """Read more text, dropping what was consumed; returns False at EOF."""
+        if self.eof:
+            return False
+        chunk = self.fh.read(max(self.chunk_size, size or 0))
+        if self.pos:
+            newline = self.buf.rfind("\n", 0, self.pos)
+            if newline >= 0:
+                self.lineno += self.buf.count("\n", 0, self.pos)
+                self.colno = self.pos - newline
+            else:
+                self.colno += self.pos
+            self.consumed += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def _error(self, msg, pos=None):
+        """Return a JSONDecodeError for pos in buf, located in the whole document."""
+        pos = self.pos if pos is None else pos
+        err = json.JSONDecodeError(msg, self.buf, pos)
+        newline = self.buf.rfind("\n", 0, pos)
+        err.pos = self.consumed + pos
+        err.lineno = self.lineno + self.buf.count("\n", 0, pos)
+        err.colno = pos - newline if newline >= 0 else self.colno + pos
+        err.args = (f"{msg}: line {err.lineno} column {err.colno} (char {err.pos})",)
+        return err
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or None at EOF."""
+        if self.pos < len(self.buf) and self.buf[self.pos] not in " \t\n\r":
+            return self.buf[self.pos]
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _next(self, expected):
+        ch = self._peek()
+        if ch is None or ch not in expected:
+            raise self._error(f"Expecting one of '{expected}'")
+        self.pos += 1
+        return ch
+
+    def decode_value(self):
+        if self._peek() is None:
+            raise self._error("Expecting value")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as err:
+                # read more only if the value may go on in the next chunk,
+                # so a malformed value does not pull in the rest of the file
+                cut = (err.pos >= len(self.buf) - _CUT_VALUE_TAIL
+                       or err.msg.startswith("Unterminated string"))
+                if not cut or not self._fill(len(self.buf)):
+                    raise self._error(err.msg, err.pos) from None
+                continue
+            # a number cut by the end of the chunk (e.g. "12." of "12.5")
+            # decodes as its prefix, so make sure something else follows it
+            if self.eof or end < len(self.buf) and self.buf[end] not in _NUMBER_CHARS:
+                self.pos = end
+                return value
+            self._fill(len(self.buf))
+
+    def skip_value(self):
+        ch = self._peek()
+        if ch not in ("{", "["):
+            self.decode_value()
+            return
+        self.pos += 1
+        depth = 1
+        search = _SKIP_TOKEN.search
+        while depth:
+            match = search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise self._error("Unterminated JSON value")
+                continue
+            token = match.group()
+            if token == '"':
+                # the string goes on in the next chunk
+                self.pos = match.start()
+                if not self._fill(len(self.buf)):
+                    raise self._error("Unterminated string")
+                continue
+            self.pos = match.end()
+            if token in "[{":
+                depth += 1
+            elif token in "]}":
+                depth -= 1
+
+    def walk(self, path, depth=0):
+        """Yield the values at path[depth:] below the value at the current position."""
+        if depth == len(path):
+            yield self.decode_value()
+            return
+        part = path[depth]
+        ch = self._peek()
+        if ch != ("[" if part is _ALL_ITEMS else "{"):
+            # not the container the path expects: nothing matches
+            self.skip_value()
+            return
+        self.pos += 1
+        if self._peek() == ("]" if part is _ALL_ITEMS else "}"):
+            self.pos += 1
+            return
+        leaf = depth + 1 == len(path)
+        while True:
+            if part is _ALL_ITEMS and leaf:
+                yield self.decode_value()
+                if self._next(",]") == "]":
+                    return
+            elif part is _ALL_ITEMS:
+                yield from self.walk(path, depth + 1)
+                if self._next(",]") == "]":
+                    return
+            else:
+                if self._peek() != '"':
+                    raise self._error("Expecting property name enclosed in double quotes")
+                key = self.decode_value()
+                self._next(":")
+                if key == part:
+                    yield from self.walk(path, depth + 1)
+                else:
+                    self.skip_value()
+                if self._next(",}") == "}":
+                    return
+
+
+def iter_json_file(json_file, path="[*]", uselzma = False):
+    """Incrementally yield the values at path in a JSON file as (value, error msg) tuples.
+
+    path selects object members by name and every array item with [*],
+    e.g. "[*]" for the items of a top-level array, "received[*]" for the
+    items of the "received" array of a top-level object or "a.b" for a
+    single nested value. The file is read in chunks and only the selected
+    values are decoded, so documents larger than memory can be processed
+    one value at a time. Every value is yielded as (value, None); an
+    error (same messages as load_json_file()) is yielded once as
+    (None, error msg) and ends the iteration, possibly after some values.
+    """
+    try:
+        parts = _parse_json_path(path)
+    except ValueError as err:
+        yield None, str(err)
+        return
+    err_msg = None
+    try:
+        if uselzma:
+            input_fp = lzma.open(json_file, 'rt')
+        else:
+            input_fp = open(json_file, 'r')
+        with input_fp:
+            stream = _JSONStream(input_fp)
+            for value in stream.walk(parts):
+                yield value, None
+            if stream._peek() is not None:
+                raise stream._error("Extra data")
+        return
+    except FileNotFoundError as err:
+        err_msg = f"Could not find JSON file { json_file }:{ err }"
+    except IOError as err:
+        err_msg = f"Could not open/read JSON file { json_file }:{ err }"
+    except json.JSONDecodeError as err:
+        err_msg = f"Decoding JSON file { json_file } has failed: { err }"
+    except Exception as err:
+        err_msg = f"Unexpected error opening JSON file { json_file }:{ err }"
+    yield None, err_msg
+
+
+def save_json_file(filename, data, schema_file=None, compact=False):
     """Save a Python object as JSON with automatic xz compression.
 
+    The JSON is indented with sorted keys, unless compact is set: then it
+    is written on one line in dict order, which is faster to produce.
     Returns (actual_filename, error_msg). On success error_msg is None.
     """
     if schema_file is not None:
@@ -42,7 +414,10 @@ def save_json_file(filename, data, schema_file=None):
             return None, err
 
     try:
-        json_text = json.dumps(data, indent=2, sort_keys=True) + "\n"
+        if compact:
+            json_text = json_dumps(data) + "\n"
+        else:
+            json_text = json_dumps(data, indent=2, sort_keys=True) + "\n"
     except (TypeError, ValueError) as err:
         return None, f"Could not encode JSON: {err}"
 
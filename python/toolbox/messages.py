@@ -1,12 +1,11 @@
 # -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
-import json
 import logging
 import os
 from pathlib import Path
 
-from toolbox.json import load_json_file
+from toolbox.json import iter_json_file, json_dumps, load_json_file
 
 
 logger = logging.getLogger(__name__)
@@ -126,7 +125,7 @@ def prepare_user_msgs_file(tx_msgs_dir, output_dir, roadblock_name,
     logger.info("Writing %d user message(s) to %s", len(user_msgs), msgs_file)
 
     with open(msgs_file, "w", encoding="ascii") as fp:
-        json.dump(user_msgs, fp, indent=4, sort_keys=True)
+        fp.write(json_dumps(user_msgs, indent=4, sort_keys=True))
 
     return msgs_file
 
@@ -189,16 +188,14 @@ def evaluate_roadblock_result(roadblock_rc, roadblock_name, msgs_dir,
 
     logger.info("Found received messages file: %s", msgs_log_file)
 
-    msgs_json, err = load_json_file(msgs_log_file)
-    if msgs_json is None:
-        logger.error("Failed to load %s: %s", msgs_log_file, err)
-        return result
-
-    received = msgs_json.get("received", [])
-    if not received:
-        return result
+    # The message log can be large; only its "received" messages are
+    # decoded, one at a time.
+    messages = []
+    for msg, err in iter_json_file(msgs_log_file, "received[*]"):
+        if err is not None:
+            logger.error("Failed to load %s: %s", msgs_log_file, err)
+            return result
 
-    for msg in received:
         payload = msg.get("payload", {})
         message = payload.get("message", {})
 
@@ -214,14 +211,15 @@ def evaluate_roadblock_result(roadblock_rc, roadblock_name, msgs_dir,
 
         if engine_label is not None:
             if recipient.get("id") == engine_label:
-                result["messages"].append(user_object)
+                messages.append(user_object)
             elif (buddy_label is not None
                   and sender.get("id") == buddy_label
                   and recipient.get("type") == "all"):
-                result["messages"].append(user_object)
+                messages.append(user_object)
         else:
-            result["messages"].append(user_object)
+            messages.append(user_object)
 
+    result["messages"] = messages
     logger.info("Found %d message(s) for processing", len(result["messages"]))
 
     return result
@@ -243,7 +241,7 @@ def save_received_messages(messages, rx_msgs_dir, roadblock_label):
         outfile = os.path.join(rx_msgs_dir, filename)
         logger.info("Saving message to %s", outfile)
         with open(outfile, "w", encoding="ascii") as fp:
-            json.dump(msg, fp, indent=4, sort_keys=True)
+            fp.write(json_dumps(msg, indent=4, sort_keys=True))
 
     return len(messages)
 
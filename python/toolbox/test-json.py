@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import sys
+import os
+# this directory holds toolbox/json.py and toolbox/logging.py, which
+# must not shadow the standard library modules
+sys.path = [path for path in sys.path if os.path.abspath(path or ".") != os.path.dirname(os.path.abspath(__file__))]
+
+import dataclasses
+import datetime
+import enum
+import json
+import uuid
+from pathlib import Path
+
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.json import available_json_backends, json_dumps, set_json_backend
+
+
+class Color(enum.Enum):
+    RED = "red"
+
+
+class Level(enum.IntEnum):
+    HIGH = 2
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+# values the fast backends may encode differently from the stdlib
+VALUES = {
+    "datetime": datetime.datetime(2024, 1, 2, 3, 4, 5),
+    "date": datetime.date(2024, 1, 2),
+    "time": datetime.time(3, 4, 5),
+    "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    "dataclass": Point(1, 2),
+    "enum": Color.RED,
+    "int enum": Level.HIGH,
+    "nan": float("nan"),
+    "infinity": float("-inf"),
+}
+
+
+def check(name, condition):
+    print("%-60s %s" % (name, "ok" if condition else "FAILED"))
+    return condition
+
+
+def encode(dumps, obj, **kwargs):
+    """Return the encoded text, or the type of the exception raised."""
+    try:
+        return dumps(obj, **kwargs)
+    except Exception as err:
+        return type(err)
+
+
+def main():
+    ok = True
+    for backend in available_json_backends():
+        set_json_backend(backend)
+        for name, value in VALUES.items():
+            for obj in (value, {"a": [1, {"b": value}]}):
+                for kwargs in ({}, {"indent": 2, "sort_keys": True}):
+                    expected = encode(json.dumps, obj, **kwargs)
+                    ok &= check("%s: %s%s%s" % (backend, name, ", nested" if obj is not value else "",
+                                                ", indent=2" if kwargs else ""),
+                                encode(json_dumps, obj, **kwargs) == expected)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    exit(main())
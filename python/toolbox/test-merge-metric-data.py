@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import tempfile
+from pathlib import Path
+
+import sys
+import os
+# this directory holds toolbox/json.py and toolbox/logging.py, which
+# must not shadow the standard library modules
+sys.path = [path for path in sys.path if os.path.abspath(path or ".") != os.path.dirname(os.path.abspath(__file__))]
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.cdm_merge import merge_metric_data
+from toolbox.cdm_metrics import CDMMetrics
+from toolbox.cdm_reader import MetricDataReader
+
+
+DESC = {'class': 'throughput', 'source': 'test', 'type': 'count'}
+
+
+def samples_by_metric(path_prefix):
+    reader = MetricDataReader(path_prefix)
+    samples = {}
+    for sample in reader.samples():
+        metric = reader.metric_types[sample.idx]
+        key = tuple(sorted(metric['names'].items()))
+        samples.setdefault(key, []).append((sample.begin, sample.end, sample.value))
+    return samples
+
+
+def check(name, condition):
+    print("%-60s %s" % (name, "ok" if condition else "FAILED"))
+    return condition
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    ends_a = list(range(1000, 20001, 1000))
+    ends_b = list(range(21000, 40001, 1000))
+    values_x = [k // 3 for k in range(40)]
+
+    # Input a is not sorted by end: log_samples() writes metric x's whole
+    # series before metric z's row (end 38000) is written at finish.
+    cdm = CDMMetrics(os.path.join(tmp_dir, "a"))
+    cdm.log_sample("0", DESC, {'metric': 'z'}, {'end': 38000, 'value': 1})
+    cdm.log_sample("0", DESC, {'metric': 'z'}, {'end': 39000, 'value': 2})
+    cdm.log_samples("0", DESC, {'metric': 'x'}, ends_a, values_x[:20])
+    input_a = os.path.join(tmp_dir, "a", cdm.finish_samples(dont_delete=True))
+
+    cdm = CDMMetrics(os.path.join(tmp_dir, "b"))
+    cdm.log_samples("0", DESC, {'metric': 'x'}, ends_b, values_x[20:])
+    input_b = os.path.join(tmp_dir, "b", cdm.finish_samples(dont_delete=True))
+
+    # the same samples logged into one file
+    cdm = CDMMetrics(os.path.join(tmp_dir, "ref"))
+    cdm.log_sample("0", DESC, {'metric': 'z'}, {'end': 38000, 'value': 1})
+    cdm.log_sample("0", DESC, {'metric': 'z'}, {'end': 39000, 'value': 2})
+    cdm.log_samples("0", DESC, {'metric': 'x'}, ends_a + ends_b, values_x)
+    reference = os.path.join(tmp_dir, "ref", cdm.finish_samples(dont_delete=True))
+
+    ok = True
+    merged = os.path.join(tmp_dir, "merged", merge_metric_data([input_a, input_b], os.path.join(tmp_dir, "merged")))
+    ok &= check("time slices merge like a single file", samples_by_metric(merged) == samples_by_metric(reference))
+
+    try:
+        merge_metric_data([input_b, input_a], os.path.join(tmp_dir, "reversed"))
+        ok &= check("inputs out of time order raise ValueError", False)
+    except ValueError:
+        ok &= check("inputs out of time order raise ValueError", True)
+
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import io
+import lzma
+import random
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import sys
+import os
+# this directory holds toolbox/json.py and toolbox/logging.py, which
+# must not shadow the standard library modules
+sys.path = [path for path in sys.path if os.path.abspath(path or ".") != os.path.dirname(os.path.abspath(__file__))]
+TOOLBOX_HOME = os.environ.get('TOOLBOX_HOME')
+if TOOLBOX_HOME is None:
+    print("This script requires libraries that are provided by the toolbox project.")
+    print("Toolbox can be acquired from https://github.com/perftool-incubator/toolbox and")
+    print("then use 'export TOOLBOX_HOME=/path/to/toolbox' so that it can be located.")
+    exit(1)
+else:
+    p = Path(TOOLBOX_HOME) / 'python'
+    if not p.exists() or not p.is_dir():
+        print("ERROR: <TOOLBOX_HOME>/python ('%s') does not exist!" % (p))
+        exit(2)
+    sys.path.append(str(p))
+from toolbox.xz import XZBlockReader, XZBlockWriter, read_index
+
+
+BLOCK_SIZE = 1 << 16
+
+
+def check(name, condition):
+    print("%-60s %s" % (name, "ok" if condition else "FAILED"))
+    return condition
+
+
+def make_lines(num):
+    rnd = random.Random(1)
+    return [("%d,%d,%d,%s\n" % (rnd.randrange(100), i * 1000 + 1, i * 1000 + 1000, rnd.random())).encode()
+            for i in range(num)]
+
+
+def write_file(filename, lines, threads):
+    writer = XZBlockWriter(filename, 6, BLOCK_SIZE, threads=threads)
+    for line in lines:
+        writer.write(line)
+    writer.close()
+    return writer.blocks
+
+
+def xz_test(filename):
+    """Return True if xz(1) accepts the file, or if xz is not installed."""
+    if shutil.which("xz") is None:
+        return True
+    return subprocess.run(["xz", "-t", filename]).returncode == 0
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    lines = make_lines(50000)
+    data = b"".join(lines)
+    ok = True
+
+    single = os.path.join(tmp_dir, "single.xz")
+    blocks = write_file(single, lines, 1)
+    with open(single, "rb") as fh:
+        compressed = fh.read()
+    ok &= check("threads=1: several blocks", len(blocks) > 1)
+    ok &= check("threads=1: lzma.decompress() reads it back", lzma.decompress(compressed) == data)
+    ok &= check("threads=1: xz -t", xz_test(single))
+    with open(single, "rb") as fh:
+        ok &= check("read_index() finds the written blocks", [block for block, _ in read_index(fh)] == blocks)
+
+    parallel = os.path.join(tmp_dir, "parallel.xz")
+    write_file(parallel, lines, 3)
+    with open(parallel, "rb") as fh:
+        ok &= check("threads=3: lzma.decompress() reads it back", lzma.decompress(fh.read()) == data)
+    ok &= check("threads=3: xz -t", xz_test(parallel))
+
+    unsplit = os.path.join(tmp_dir, "unsplit.xz")
+    writer = XZBlockWriter(unsplit, 6, BLOCK_SIZE, threads=3, split_writes=False)
+    for line in lines:
+        writer.write(line)
+    writer.close()
+    with open(unsplit, "rb") as fh:
+        ok &= check("threads=3, split_writes=False: same bytes as threads=1", fh.read() == compressed)
+
+    large = os.path.join(tmp_dir, "large.xz")
+    writer = XZBlockWriter(large, 6, BLOCK_SIZE, threads=3)
+    writer.write(data)
+    writer.close()
+    with open(large, "rb") as fh:
+        ok &= check("threads=3: one large write() makes several blocks",
+                    len(writer.blocks) > 1 and lzma.decompress(fh.read()) == data)
+    ok &= check("threads=3: blocks end at a newline",
+                all(data[block.uncompressed_offset + block.uncompressed_size - 1] == ord("\n")
+                    for block in writer.blocks))
+
+    # an unfinished writer: synced blocks, more data that never got synced, no footer
+    resumed = os.path.join(tmp_dir, "resumed.xz")
+    half = len(lines) // 2
+    writer = XZBlockWriter(resumed, 6, BLOCK_SIZE)
+    for line in lines[:half]:
+        writer.write(line)
+    saved = writer.sync()
+    for line in lines[half:half + 1000]:
+        writer.write(line)
+    writer.flush_block()
+    writer.fh.close()
+    writer = XZBlockWriter(resumed, 6, BLOCK_SIZE, blocks=saved)
+    for line in lines[half:]:
+        writer.write(line)
+    writer.close()
+    with open(resumed, "rb") as fh:
+        ok &= check("blocks= resume continues after the synced blocks", lzma.decompress(fh.read()) == data)
+    ok &= check("resumed file: xz -t", xz_test(resumed))
+
+    for threads in (None, 2):
+        with io.BufferedReader(XZBlockReader(parallel, threads)) as fh:
+            middle = len(data) // 2
+            fh.seek(middle)
+            ok &= check("XZBlockReader(threads=%s): seek to the middle" % threads,
+                        fh.read(5000) == data[middle:middle + 5000])
+            fh.seek(-100, 2)
+            ok &= check("XZBlockReader(threads=%s): seek to the tail" % threads, fh.read() == data[-100:])
+            fh.seek(0)
+            ok &= check("XZBlockReader(threads=%s): read everything" % threads, fh.read() == data)
+
+    shutil.rmtree(tmp_dir)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,526 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+"""Multi-block .xz files whose blocks can be decompressed independently.
+
+The stdlib lzma module writes a whole .xz stream as a single block, so
+the only way to get at any part of the data is to decompress everything
+before it. XZBlockWriter instead compresses every block_size bytes of
+input as a separate block (each with its own LZMA2 dictionary) in one
+standard .xz stream, readable by lzma.open() and plain "xz -d".
+decompress_block() then decodes any one block on its own from its
+offset and sizes.
+
+Since the blocks are independent, XZBlockWriter can also compress
+several of them at once on a thread pool (liblzma releases the GIL), and
+XZBlockReader decompresses them in parallel and seeks to any offset of
+the uncompressed data using the index that ends every .xz stream.
+"""
+
+import io
+import lzma
+import os
+import zlib
+from bisect import bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+_HEADER_SIZE = 12
+_FOOTER_SIZE = 12
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Stream flags: CRC32 integrity check, which zlib can compute
+_CHECK_CRC32 = 0x01
+_FILTER_LZMA2 = 0x21
+# Dictionary size of each xz preset (see xz(1)); blocks never need more
+# than their own size.
+_PRESET_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+XZBlock = namedtuple("XZBlock", ["offset", "unpadded_size", "uncompressed_offset", "uncompressed_size"])
+
+
+def _crc32(data):
+    return zlib.crc32(data).to_bytes(4, "little")
+
+
+def _encode_vli(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_vli(data, pos):
+    """Return (value, position after it) of the variable-length integer at pos."""
+    value = 0
+    for i in range(9):
+        byte = data[pos + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise ValueError("Invalid variable-length integer in xz index")
+
+
+def _pad4(size):
+    return -size % 4
+
+
+def _stream_flags(check_type):
+    return bytes([0x00, check_type])
+
+
+def _stream_header(check_type):
+    flags = _stream_flags(check_type)
+    return XZ_MAGIC + flags + _crc32(flags)
+
+
+def _stream_index_and_footer(records, check_type):
+    """Return the index and stream footer for (unpadded, uncompressed) records."""
+    index = bytearray(b"\x00")
+    index += _encode_vli(len(records))
+    for unpadded_size, uncompressed_size in records:
+        index += _encode_vli(unpadded_size)
+        index += _encode_vli(uncompressed_size)
+    index += bytes(_pad4(len(index)))
+    index += _crc32(index)
+    backward_size = (len(index) // 4 - 1).to_bytes(4, "little")
+    flags = _stream_flags(check_type)
+    return bytes(index) + _crc32(backward_size + flags) + backward_size + flags + XZ_FOOTER_MAGIC
+
+
+def _lzma2_dict_size(preset, block_size):
+    """Return (dict_size, LZMA2 dictionary property byte) for a block."""
+    preset_dict_size = _PRESET_DICT_SIZES[preset & ~lzma.PRESET_EXTREME]
+    limit = min(preset_dict_size, max(block_size, 4096))
+    for prop in range(40):
+        dict_size = (2 | (prop & 1)) << (prop // 2 + 11)
+        if dict_size >= limit:
+            return dict_size, prop
+    return preset_dict_size, 40
+
+
+def _parse_index(index, check_type, stream_offset):
+    """Return the XZBlocks listed in the index of a stream starting at stream_offset.
+
+    uncompressed_offset is relative to the start of that stream.
+    """
+    if index[0] != 0x00 or _crc32(index[:-4]) != index[-4:]:
+        raise ValueError("Corrupt xz index")
+    num, pos = _decode_vli(index, 1)
+    blocks = []
+    offset = stream_offset + _HEADER_SIZE
+    uncompressed_offset = 0
+    for _ in range(num):
+        unpadded_size, pos = _decode_vli(index, pos)
+        uncompressed_size, pos = _decode_vli(index, pos)
+        blocks.append(XZBlock(offset, unpadded_size, uncompressed_offset, uncompressed_size))
+        offset += unpadded_size + _pad4(unpadded_size)
+        uncompressed_offset += uncompressed_size
+    return blocks
+
+
+def read_index(fh):
+    """Return the blocks of an .xz file, read from the index of each stream.
+
+    fh is an open, seekable binary file. Only the stream footers and
+    indexes at the end of the streams are read, nothing is decompressed.
+    Returns a list of (XZBlock, check type) in file order;
+    uncompressed_offset counts from the start of the file's uncompressed
+    data, across concatenated streams.
+    """
+    fh.seek(0, 2)
+    end = fh.tell()
+    streams = []
+    while end > 0:
+        # stream padding: null bytes in multiples of four
+        fh.seek(end - 4)
+        if fh.read(4) == bytes(4):
+            end -= 4
+            continue
+        if end < _HEADER_SIZE + _FOOTER_SIZE:
+            raise ValueError("Truncated xz file")
+        fh.seek(end - _FOOTER_SIZE)
+        footer = fh.read(_FOOTER_SIZE)
+        if footer[10:] != XZ_FOOTER_MAGIC or _crc32(footer[4:10]) != footer[:4]:
+            raise ValueError("No xz stream footer at the end of the file (truncated?)")
+        check_type = footer[9]
+        index_size = (int.from_bytes(footer[4:8], "little") + 1) * 4
+        index_offset = end - _FOOTER_SIZE - index_size
+        if index_offset < _HEADER_SIZE:
+            raise ValueError("Corrupt xz stream footer")
+        fh.seek(index_offset)
+        index = fh.read(index_size)
+        # the blocks sit right before the index, the stream header before them
+        sizes = _parse_index(index, check_type, 0)
+        blocks_size = sum(block.unpadded_size + _pad4(block.unpadded_size) for block in sizes)
+        stream_offset = index_offset - blocks_size - _HEADER_SIZE
+        if stream_offset < 0:
+            raise ValueError("Corrupt xz index")
+        fh.seek(stream_offset)
+        header = fh.read(_HEADER_SIZE)
+        if header[:6] != XZ_MAGIC or header[6:8] != footer[8:10]:
+            raise ValueError("xz stream header does not match its footer")
+        streams.append((_parse_index(index, check_type, stream_offset), check_type))
+        end = stream_offset
+    result = []
+    uncompressed_offset = 0
+    for blocks, check_type in reversed(streams):
+        for block in blocks:
+            result.append((block._replace(uncompressed_offset=uncompressed_offset + block.uncompressed_offset),
+                           check_type))
+        if blocks:
+            uncompressed_offset += blocks[-1].uncompressed_offset + blocks[-1].uncompressed_size
+    return result
+
+
+def compress_block(data, preset=None, dict_size=None, dict_prop=None):
+    """Compress data as one complete .xz block.
+
+    Returns (block bytes, unpadded size). The block includes its header,
+    padding and CRC32 check and can be placed in any stream with CRC32
+    stream flags.
+    """
+    if preset is None:
+        preset = 6
+    if dict_size is None:
+        dict_size, dict_prop = _lzma2_dict_size(preset, len(data))
+    compressor = lzma.LZMACompressor(
+        format=lzma.FORMAT_RAW,
+        filters=[{"id": lzma.FILTER_LZMA2, "preset": preset, "dict_size": dict_size}],
+    )
+    compressed = compressor.compress(data) + compressor.flush()
+
+    fields = (bytes([0xC0]) + _encode_vli(len(compressed)) + _encode_vli(len(data))
+              + _encode_vli(_FILTER_LZMA2) + _encode_vli(1) + bytes([dict_prop]))
+    header_size = 1 + len(fields) + 4
+    header_size += _pad4(header_size)
+    header = bytes([header_size // 4 - 1]) + fields
+    header += bytes(header_size - 4 - len(header))
+    header += _crc32(header)
+
+    unpadded_size = len(header) + len(compressed) + 4
+    block = header + compressed + bytes(_pad4(len(compressed))) + _crc32(data)
+    return block, unpadded_size
+
+
+def decompress_block(block, unpadded_size, uncompressed_size, check_type=_CHECK_CRC32):
+    """Decompress one block (as stored in a file, padding included) on its own.
+
+    The block is wrapped in a minimal single-block stream so that liblzma
+    verifies its headers and integrity check as usual.
+    """
+    stream = (_stream_header(check_type) + bytes(block)
+              + _stream_index_and_footer([(unpadded_size, uncompressed_size)], check_type))
+    return lzma.decompress(stream, format=lzma.FORMAT_XZ)
+
+
+def read_block(fh, block, check_type=_CHECK_CRC32):
+    """Read and decompress an XZBlock from an open binary file."""
+    fh.seek(block.offset)
+    data = fh.read(block.unpadded_size + _pad4(block.unpadded_size))
+    return decompress_block(data, block.unpadded_size, block.uncompressed_size, check_type)
+
+
+def _pread_block(fd, block, check_type):
+    # os.pread() does not move the file position, so threads can share fd
+    data = os.pread(fd, block.unpadded_size + _pad4(block.unpadded_size), block.offset)
+    return decompress_block(data, block.unpadded_size, block.uncompressed_size, check_type)
+
+
+class XZBlockReader(io.RawIOBase):
+    """Seekable binary reader of the uncompressed data of an .xz file.
+
+    The blocks are located with read_index(), so seek() to any offset
+    only decompresses the block that contains it. Any .xz file works,
+    but a file written by lzma.open() or plain "xz" is usually a single
+    block, which then has to be decompressed as a whole; files written by
+    XZBlockWriter (or "xz -T" / "xz --block-size") have many.
+
+    With threads > 1 (0 for one per CPU), while the data is read the
+    next read_ahead blocks (2 per thread by default) are decompressed in
+    parallel on a thread pool. Memory use is about (read_ahead + 1)
+    uncompressed blocks. Wrap it in io.BufferedReader/io.TextIOWrapper
+    for line reading, as open_read_text_file() does.
+    """
+
+    def __init__(self, filename, threads=None, read_ahead=None):
+        super().__init__()
+        self.filename = filename
+        self.fh = open(filename, "rb")
+        try:
+            self.blocks = read_index(self.fh)
+        except (ValueError, IndexError) as exc:
+            self.fh.close()
+            raise ValueError(f"{filename}: {exc}") from None
+        self._ends = [block.uncompressed_offset + block.uncompressed_size for block, _ in self.blocks]
+        self.size = self._ends[-1] if self._ends else 0
+        if threads == 0:
+            threads = os.cpu_count() or 1
+        self.threads = threads if threads is not None else 1
+        self.read_ahead = read_ahead if read_ahead is not None else 2 * self.threads
+        self._executor = None
+        if self.threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="xz-read")
+        # block number -> future of its data
+        self._futures = {}
+        self._current = None
+        self._data = b""
+        self._position = 0
+
+    @property
+    def name(self):
+        return self.filename
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            position = offset
+        elif whence == 1:
+            position = self._position + offset
+        elif whence == 2:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def _load(self, number):
+        if self._executor is None:
+            return _pread_block(self.fh.fileno(), *self.blocks[number])
+        future = self._futures.pop(number, None)
+        if future is None:
+            future = self._executor.submit(_pread_block, self.fh.fileno(), *self.blocks[number])
+        last = min(number + self.read_ahead, len(self.blocks) - 1)
+        # drop read-ahead left over from before a seek
+        for stale in [n for n in self._futures if n < number or n > last]:
+            self._futures.pop(stale).cancel()
+        for ahead in range(number + 1, last + 1):
+            if ahead not in self._futures:
+                self._futures[ahead] = self._executor.submit(_pread_block, self.fh.fileno(), *self.blocks[ahead])
+        return future.result()
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        number = bisect_right(self._ends, self._position)
+        if number != self._current:
+            self._data = b""
+            self._data = self._load(number)
+            self._current = number
+        start = self._position - self.blocks[number][0].uncompressed_offset
+        count = min(len(buffer), len(self._data) - start)
+        memoryview(buffer)[:count] = memoryview(self._data)[start:start + count]
+        self._position += count
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+                self._futures = {}
+            self._data = b""
+            self.fh.close()
+        finally:
+            super().close()
+
+
+class XZBlockWriter:
+    """Writable file object producing a multi-block .xz file.
+
+    Data is buffered until at least block_size bytes are pending, then
+    compressed as one independent block. Unless split_writes is set, a
+    single write() call is never split across blocks, so writing whole
+    lines keeps every block made of whole lines and num_blocks is the
+    number of the block the next write() goes to (CDMMetrics relies on
+    both for its index). With split_writes (the default with threads
+    > 1) data is cut into blocks of at most block_size bytes, at the
+    last newline before each boundary when there is one, so that a
+    single large write() is still compressed in parallel. str data is
+    encoded as UTF-8. blocks lists the XZBlock of every block written so
+    far.
+
+    Passing the blocks of an earlier, unfinished writer of the same file
+    resumes it: the file is truncated right after the last of those
+    blocks (dropping anything written later) and appended to.
+
+    With threads > 1 (0 for one per CPU) blocks are compressed by a pool
+    of that many threads while write() goes on buffering the next ones;
+    they are still written to the file in order, so the output is the
+    same as with a single thread. At most two blocks per thread are in
+    flight, which bounds the memory used. blocks only lists the blocks
+    already written to the file (flush(), sync() and close() write all
+    of them).
+    """
+
+    def __init__(self, filename, preset=None, block_size=DEFAULT_BLOCK_SIZE, blocks=None, threads=None,
+                 split_writes=None):
+        self.filename = filename
+        self.preset = 6 if preset is None else preset
+        self.block_size = block_size
+        self.dict_size, self.dict_prop = _lzma2_dict_size(self.preset, block_size)
+        self.blocks = []
+        self._buffer = []
+        self._buffered = 0
+        self._uncompressed_offset = 0
+        if threads == 0:
+            threads = os.cpu_count() or 1
+        self.threads = threads if threads is not None else 1
+        self.split_writes = self.threads > 1 if split_writes is None else split_writes
+        self._executor = None
+        # (future of compress_block(), uncompressed size) in file order
+        self._pending = deque()
+        if blocks is None:
+            self.fh = open(filename, "wb")
+            self.fh.write(_stream_header(_CHECK_CRC32))
+            self._offset = self.fh.tell()
+        else:
+            self.fh = open(filename, "r+b")
+            if self.fh.read(len(XZ_MAGIC)) != XZ_MAGIC:
+                self.fh.close()
+                raise ValueError(f"{filename} is not an xz file")
+            self._offset = len(_stream_header(_CHECK_CRC32))
+            for block in blocks:
+                block = XZBlock(*block)
+                if block.offset != self._offset or block.uncompressed_offset != self._uncompressed_offset:
+                    self.fh.close()
+                    raise ValueError(f"Blocks of {filename} are not contiguous")
+                self.blocks.append(block)
+                self._offset += block.unpadded_size + _pad4(block.unpadded_size)
+                self._uncompressed_offset += block.uncompressed_size
+            self.fh.seek(0, 2)
+            if self.fh.tell() < self._offset:
+                self.fh.close()
+                raise ValueError(f"{filename} is shorter than its blocks")
+            self.fh.truncate(self._offset)
+            self.fh.seek(self._offset)
+        if self.threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="xz-block")
+
+    @property
+    def closed(self):
+        return self.fh is None
+
+    @property
+    def num_blocks(self):
+        return len(self.blocks) + len(self._pending)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self.block_size:
+            return len(data)
+        if not self.split_writes:
+            self.flush_block()
+            return len(data)
+        buffered = self._take_buffer()
+        start = 0
+        while len(buffered) - start >= self.block_size:
+            end = buffered.rfind(b"\n", start, start + self.block_size) + 1
+            if end <= start:
+                # no newline in the whole block
+                end = start + self.block_size
+            self._compress(buffered[start:end])
+            start = end
+        if start < len(buffered):
+            self._buffer.append(buffered[start:])
+            self._buffered = len(buffered) - start
+        return len(data)
+
+    def _take_buffer(self):
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        return data
+
+    def _append_block(self, block, unpadded_size, uncompressed_size):
+        self.fh.write(block)
+        self.blocks.append(XZBlock(self._offset, unpadded_size, self._uncompressed_offset, uncompressed_size))
+        self._offset += len(block)
+        self._uncompressed_offset += uncompressed_size
+
+    def _write_pending(self, keep=0):
+        """Write compressed blocks, in order, until at most keep are pending."""
+        while len(self._pending) > keep:
+            future, uncompressed_size = self._pending[0]
+            block, unpadded_size = future.result()
+            self._pending.popleft()
+            self._append_block(block, unpadded_size, uncompressed_size)
+
+    def flush_block(self):
+        """Compress and write whatever is buffered as a block.
+
+        With threads, the block is only queued for compression; blocks
+        are written once they are done and all the blocks before them
+        have been written.
+        """
+        if self._buffered:
+            self._compress(self._take_buffer())
+
+    def _compress(self, data):
+        if self._executor is None:
+            block, unpadded_size = compress_block(data, self.preset, self.dict_size, self.dict_prop)
+            self._append_block(block, unpadded_size, len(data))
+            return
+        future = self._executor.submit(compress_block, data, self.preset, self.dict_size, self.dict_prop)
+        self._pending.append((future, len(data)))
+        while self._pending and self._pending[0][0].done():
+            self._write_pending(len(self._pending) - 1)
+        self._write_pending(2 * self.threads)
+
+    def flush(self):
+        self._write_pending()
+        self.fh.flush()
+
+    def sync(self):
+        """Compress the buffered data as a block and make all blocks durable.
+
+        Returns the list of blocks, which can be passed back to the
+        constructor to resume writing after this point.
+        """
+        self.flush_block()
+        self._write_pending()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        return list(self.blocks)
+
+    def close(self):
+        if self.fh is None:
+            return
+        try:
+            self.flush_block()
+            self._write_pending()
+            records = [(block.unpadded_size, block.uncompressed_size) for block in self.blocks]
+            self.fh.write(_stream_index_and_footer(records, _CHECK_CRC32))
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+                self._pending.clear()
+            self.fh.close()
+            self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()